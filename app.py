@@ -8,11 +8,19 @@ import os
 # Set port from environment (HF Spaces provides this)
 port = int(os.environ.get("PORT", 7860))
 
+# Worker processes; with more than one, the models are loaded once and the
+# forked workers share the weights (see backend/prefork.py)
+workers = int(os.environ.get("WEB_WORKERS", 1))
+
 if __name__ == "__main__":
-    uvicorn.run(
-        "backend.main:app",
-        host="0.0.0.0",
-        port=port,
-        log_level="info"
-    )
+    if workers > 1:
+        from backend.prefork import serve
+        serve("backend.main:app", host="0.0.0.0", port=port, workers=workers, log_level="info")
+    else:
+        uvicorn.run(
+            "backend.main:app",
+            host="0.0.0.0",
+            port=port,
+            log_level="info"
+        )
 
@@ -0,0 +1,9 @@
+"""
+Benchmarks for the CVD Risk Predictor backend.
+Run them from the backend directory, e.g.:
+
+    python -m benchmarks.fusion_vessel
+
+benchmarks.suite covers every model and /predict with random-weight models
+and synthetic images, and compares runs for regressions.
+"""
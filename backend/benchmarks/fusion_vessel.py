@@ -0,0 +1,82 @@
+"""
+Benchmark the vessel stage of predict_fusion.
+
+Compares the old two-pass path (encoder features, then a second full UNet
+pass for the mask) with the single-pass return_embedding=True path, using a
+randomly initialised UNet so no checkpoint is needed.
+
+    python -m benchmarks.fusion_vessel --batch-size 1 --repeats 10
+"""
+import argparse
+import statistics
+import time
+
+import torch
+
+from main import UNet
+
+
+def two_pass(model, x):
+    features = model(x, return_features=True)
+    mask = model(x, return_features=False)
+    return mask, features
+
+
+def single_pass(model, x):
+    return model(x, return_embedding=True)
+
+
+def time_it(fn, model, x, repeats, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(model, x)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(model, x)
+            timings.append((time.perf_counter() - start) * 1000.0)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--size', type=int, default=512, help='UNet input resolution')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    model = UNet(in_ch=3, out_ch=1).eval()
+    # Same input construction as predict_fusion: a 224 tensor upsampled to 512
+    x = torch.nn.functional.interpolate(
+        torch.randn(args.batch_size, 3, 224, 224), size=(args.size, args.size),
+        mode='bilinear', align_corners=False,
+    )
+
+    with torch.no_grad():
+        old_mask, old_features = two_pass(model, x)
+        new_mask, new_features = single_pass(model, x)
+    max_diff = max(
+        (old_mask - new_mask).abs().max().item(),
+        (old_features - new_features).abs().max().item(),
+    )
+
+    old = time_it(two_pass, model, x, args.repeats, args.warmup)
+    new = time_it(single_pass, model, x, args.repeats, args.warmup)
+
+    print(f"Vessel stage of predict_fusion, batch={args.batch_size}, input={args.size}x{args.size}, "
+          f"threads={torch.get_num_threads()}")
+    print(f"  two passes : median {statistics.median(old):8.1f} ms  mean {statistics.mean(old):8.1f} ms")
+    print(f"  single pass: median {statistics.median(new):8.1f} ms  mean {statistics.mean(new):8.1f} ms")
+    saved = statistics.median(old) - statistics.median(new)
+    print(f"  saved per fusion request: {saved:.1f} ms ({100.0 * saved / statistics.median(old):.0f}%)")
+    print(f"  max abs output difference: {max_diff:.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""
+Load generator for POST /predict.
+
+Starts the API under uvicorn on a free local port with random-weight models
+(SYNTHETIC_MODELS=1) and the result and embedding caches off, or targets a
+running server with --url, and drives it with synthetic fundus images of the
+given sizes. Requests pick their model from a weighted mix. Two traffic models:
+
+- closed loop (--concurrency): N clients each send their next request as
+  soon as the previous one finishes;
+- open loop (--rate): requests arrive as a Poisson process at R requests/s
+  whatever the server's state, and latency is measured from the scheduled
+  arrival so queueing delay is not hidden.
+
+Every concurrency or rate runs for --duration seconds; passing several
+values sweeps them in order. Each step reports latency percentiles,
+throughput, error and 503 (admission control) rates, and the sweep reports
+the knee of the throughput curve: the load beyond which throughput stops
+growing in proportion and latency grows instead.
+
+    python -m benchmarks.loadgen --concurrency 1 2 4 8 16 --duration 30
+    python -m benchmarks.loadgen --rate 0.5 1 2 4 --mix hypertension=3 fusion=1 --image-sizes 1024 2048
+    python -m benchmarks.loadgen --url http://localhost:8000 --concurrency 4 --output load.json
+
+Needs httpx (pip install httpx). Everything else runs offline.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.synthetic import fundus_jpeg
+
+MODELS = ('hypertension', 'cimt', 'vessel', 'fusion')
+TWO_EYE_MODELS = ('cimt', 'fusion')
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_mix(values):
+    """['hypertension=3', 'fusion'] -> {'hypertension': 3.0, 'fusion': 1.0}"""
+    mix = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        if name not in MODELS:
+            raise SystemExit(f"Unknown model in --mix: {name} (use {', '.join(MODELS)})")
+        mix[name] = float(weight) if weight else 1.0
+    return mix
+
+
+def percentile(ordered, q: float) -> float:
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def latency_summary(latencies_ms) -> dict:
+    ordered = sorted(latencies_ms)
+    return {
+        'p50_ms': percentile(ordered, 0.50),
+        'p90_ms': percentile(ordered, 0.90),
+        'p99_ms': percentile(ordered, 0.99),
+        'max_ms': ordered[-1] if ordered else None,
+    }
+
+
+# ==================== SERVER ====================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, env_overrides) -> subprocess.Popen:
+    """uvicorn serving main:app from the backend directory.
+
+    Synthetic models, no result or embedding cache (the workload reuses a few
+    images, which would turn most requests into cache hits) and quiet logs
+    unless set in the environment or env_overrides.
+    """
+    env = dict(os.environ)
+    env.setdefault('SYNTHETIC_MODELS', '1')
+    env.setdefault('RESULT_CACHE_MB', '0')
+    env.setdefault('EMBEDDING_CACHE_MB', '0')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.update(env_overrides)
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env,
+    )
+
+
+async def wait_until_ready(url: str, timeout: float, server=None):
+    """Poll /ready until the models are loaded and warm"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url, timeout=5.0) as client:
+        while time.monotonic() < deadline:
+            if server is not None and server.poll() is not None:
+                raise SystemExit(f"Server exited with code {server.returncode} during start-up")
+            try:
+                response = await client.get('/ready')
+                if response.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(1.0)
+    raise SystemExit(f"Server at {url} not ready after {timeout:.0f}s")
+
+
+# ==================== TRAFFIC ====================
+
+class Workload:
+    """Picks the model and the synthetic images of each request"""
+
+    def __init__(self, mix: dict, image_sizes, images_per_size: int, seed: int):
+        self.rng = random.Random(seed)
+        self.models = list(mix)
+        self.weights = [mix[name] for name in self.models]
+        self.images = [
+            fundus_jpeg((size, size), seed=seed * 1000 + i)
+            for size in image_sizes for i in range(images_per_size)
+        ]
+
+    def next_request(self):
+        model = self.rng.choices(self.models, self.weights)[0]
+        if model in TWO_EYE_MODELS:
+            left, right = self.rng.sample(self.images, 2) if len(self.images) > 1 else self.images * 2
+            files = {'left_image': ('left.jpg', left, 'image/jpeg'),
+                     'right_image': ('right.jpg', right, 'image/jpeg')}
+        else:
+            files = {'image': ('image.jpg', self.rng.choice(self.images), 'image/jpeg')}
+        return model, files
+
+
+async def send(client: httpx.AsyncClient, model: str, files, started: float, records: list):
+    """POST one request and record (model, status, latency in ms); status 0 is a client-side failure"""
+    try:
+        response = await client.post('/predict', data={'model': model}, files=files)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = 0
+    records.append((model, status, (time.perf_counter() - started) * 1000.0))
+
+
+async def closed_loop(client, workload: Workload, concurrency: int, duration: float):
+    records = []
+    start = time.perf_counter()
+    end = start + duration
+
+    async def user():
+        while time.perf_counter() < end:
+            model, files = workload.next_request()
+            await send(client, model, files, time.perf_counter(), records)
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return records, time.perf_counter() - start
+
+
+async def open_loop(client, workload: Workload, rate: float, duration: float, drain_timeout: float):
+    records, tasks = [], []
+    start = time.perf_counter()
+    arrival = start
+    while True:
+        arrival += workload.rng.expovariate(rate)
+        if arrival >= start + duration:
+            break
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        model, files = workload.next_request()
+        # Latency counts from the scheduled arrival, including any lag here
+        tasks.append(asyncio.ensure_future(send(client, model, files, arrival, records)))
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        # Requests still running after the drain timeout count as failures
+        records.extend(('unfinished', 0, drain_timeout * 1000.0) for _ in pending)
+    return records, time.perf_counter() - start
+
+
+def summarize(records, elapsed: float) -> dict:
+    ok = [latency for _, status, latency in records if status == 200]
+    rejected = sum(1 for _, status, _ in records if status == 503)
+    errors = sum(1 for _, status, _ in records if status not in (200, 503))
+    total = len(records)
+    per_model = {}
+    for model in sorted({model for model, _, _ in records}):
+        latencies = [latency for name, status, latency in records if name == model and status == 200]
+        per_model[model] = {'requests': sum(1 for name, _, _ in records if name == model),
+                            **latency_summary(latencies)}
+    return {
+        'requests': total,
+        'ok': len(ok),
+        'rejected_503': rejected,
+        'errors': errors,
+        'rejected_rate': rejected / total if total else 0.0,
+        'error_rate': errors / total if total else 0.0,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(ok) / elapsed if elapsed else 0.0,
+        **latency_summary(ok),
+        'models': per_model,
+    }
+
+
+def find_knee(steps) -> dict:
+    """Knee of throughput over offered load (Kneedle: farthest point above the chord).
+
+    steps are dicts with 'load' and 'throughput_rps', in increasing load.
+    """
+    if len(steps) < 3:
+        return None
+    loads = [step['load'] for step in steps]
+    throughputs = [step['throughput_rps'] for step in steps]
+    load_span = (loads[-1] - loads[0]) or 1.0
+    peak = max(throughputs) or 1.0
+    xs = [(load - loads[0]) / load_span for load in loads]
+    ys = [throughput / peak for throughput in throughputs]
+    # Distance above the line from the first to the last point
+    slope = (ys[-1] - ys[0]) / ((xs[-1] - xs[0]) or 1.0)
+    gaps = [y - (ys[0] + slope * (x - xs[0])) for x, y in zip(xs, ys)]
+    index = max(range(len(steps)), key=lambda i: gaps[i])
+    if gaps[index] <= 0:
+        # Throughput still growing at least linearly: not saturated yet
+        index = max(range(len(steps)), key=lambda i: throughputs[i])
+    return {
+        'load': loads[index],
+        'throughput_rps': throughputs[index],
+        'p99_ms': steps[index]['p99_ms'],
+        'saturated': gaps[index] > 0,
+    }
+
+
+def print_step(kind: str, load, summary: dict):
+    p50 = summary['p50_ms']
+    p99 = summary['p99_ms']
+    print(f"  {kind} {load:>6g}: {summary['throughput_rps']:7.2f} req/s  "
+          f"p50 {p50 if p50 is not None else float('nan'):8.1f} ms  "
+          f"p99 {p99 if p99 is not None else float('nan'):8.1f} ms  "
+          f"503 {summary['rejected_rate']:6.1%}  errors {summary['error_rate']:6.1%}  "
+          f"({summary['requests']} requests)", flush=True)
+
+
+async def run(args, url: str) -> dict:
+    workload = Workload(parse_mix(args.mix), args.image_sizes, args.images_per_size, args.seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        # One request per model first, so the sweep does not measure cold models
+        for model in workload.models:
+            model_workload = Workload({model: 1.0}, args.image_sizes[:1], 1, args.seed)
+            await send(client, model, model_workload.next_request()[1], time.perf_counter(), [])
+
+        steps = []
+        if args.rate:
+            kind, loads = 'rate', args.rate
+        else:
+            kind, loads = 'concurrency', args.concurrency
+        print(f"{'Open' if kind == 'rate' else 'Closed'}-loop sweep against {url}, "
+              f"{args.duration:g}s per step, mix {args.mix}")
+        for load in loads:
+            if kind == 'rate':
+                records, elapsed = await open_loop(client, workload, load, args.duration, args.timeout)
+            else:
+                records, elapsed = await closed_loop(client, workload, int(load), args.duration)
+            summary = summarize(records, elapsed)
+            print_step(kind, load, summary)
+            steps.append({'load': load, **summary})
+            if args.pause:
+                await asyncio.sleep(args.pause)
+
+    knee = find_knee(steps)
+    if knee:
+        state = 'saturates' if knee['saturated'] else 'not saturated yet; best'
+        print(f"Knee: {state} at {kind} {knee['load']:g} with {knee['throughput_rps']:.2f} req/s")
+    return {'traffic': kind, 'steps': steps, 'knee': knee}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8],
+                      help='Closed loop: concurrent clients per step')
+    load.add_argument('--rate', type=float, nargs='+', help='Open loop: arrival rates (requests/s) per step')
+    parser.add_argument('--mix', nargs='+', default=list(MODELS),
+                        help='Models with optional weights, e.g. hypertension=3 fusion=1')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[2048], help='Upload side lengths in pixels')
+    parser.add_argument('--images-per-size', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds per step')
+    parser.add_argument('--pause', type=float, default=0.0, help='Seconds between steps')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='Existing server to test instead of starting one')
+    parser.add_argument('--server-env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='Extra environment for the started server, e.g. INFERENCE_WORKERS=2')
+    parser.add_argument('--startup-timeout', type=float, default=600.0)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        port = free_port()
+        url = f'http://127.0.0.1:{port}'
+        server = start_server(port, dict(value.split('=', 1) for value in args.server_env))
+    try:
+        if server is not None:
+            print(f"Starting server on {url} ...", flush=True)
+        asyncio.run(wait_until_ready(url, args.startup_timeout, server))
+        report = asyncio.run(run(args, url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report['arguments'] = vars(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,151 @@
+"""
+Accuracy-delta report for the reduced precision modes.
+
+Loads each model in fp32 and in every requested precision, runs them on the
+same fixed image set and reports how far the outputs move and how much faster
+they get, so a precision can be chosen per model (see MODEL_PRECISION in
+main.py). Uses the real checkpoints from MODEL_PATHS.
+
+    python -m benchmarks.precision --models hypertension cimt fusion
+    python -m benchmarks.precision --images /data/fundus --output precision.json
+
+With --images, files are taken in sorted order and consecutive files form the
+left/right pairs for cimt and fusion. Without it, synthetic images are used.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+
+import main
+from benchmarks.synthetic import fundus_image
+
+
+def load_images(directory, count):
+    if not directory:
+        return [fundus_image((768, 768), seed) for seed in range(count)]
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp'))
+    )
+    return [Image.open(os.path.join(directory, name)).convert('RGB') for name in names[:count]]
+
+
+def model_outputs(model_name, model, images, base_models):
+    """Raw outputs per image (probability, regression value or soft mask)"""
+    outputs = []
+    pairs = list(zip(images[0::2], images[1::2]))
+    if model_name == 'hypertension':
+        for image in images:
+            outputs.append(main.predict_hypertension_batch(model, main.preprocess_image(image))[0])
+    elif model_name == 'vessel':
+        for image in images:
+            outputs.append(main.predict_vessel_batch(model, main.preprocess_image_512(image))[0])
+    elif model_name == 'cimt':
+        for left, right in pairs:
+            outputs.append(main.predict_cimt_batch(
+                model, main.preprocess_image_512(left), main.preprocess_image_512(right))[0])
+    elif model_name == 'fusion':
+        # Only the fusion head changes precision; the base models stay in fp32
+        for left, right in pairs:
+            outputs.append(main.predict_fusion_batch(
+                main.preprocess_image(left), main.preprocess_image(right),
+                base_models['hypertension'], base_models['cimt'], base_models['vessel'], model,
+            )[0])
+    return outputs
+
+
+def as_score(model_name, output):
+    """Continuous score used for the delta, and the decision derived from it"""
+    if model_name == 'hypertension':
+        prediction, confidence = output
+        prob = confidence if prediction == 1 else 1.0 - confidence
+        return prob, prediction
+    if model_name == 'cimt':
+        return output, None
+    if model_name == 'fusion':
+        return output['probability'], output['prediction']
+    return output, output > 0.5
+
+
+def compare(model_name, reference, candidate):
+    if model_name == 'vessel':
+        deltas = [float(np.abs(ref - cand).mean()) for ref, cand in zip(reference, candidate)]
+        max_deltas = [float(np.abs(ref - cand).max()) for ref, cand in zip(reference, candidate)]
+        ious = []
+        for ref, cand in zip(reference, candidate):
+            ref_mask, cand_mask = ref > 0.5, cand > 0.5
+            union = np.logical_or(ref_mask, cand_mask).sum()
+            ious.append(float(np.logical_and(ref_mask, cand_mask).sum() / union) if union else 1.0)
+        return {
+            'mean_abs_delta': statistics.mean(deltas),
+            'max_abs_delta': max(max_deltas),
+            'mask_iou': statistics.mean(ious),
+        }
+
+    scores = [(as_score(model_name, ref), as_score(model_name, cand)) for ref, cand in zip(reference, candidate)]
+    deltas = [abs(ref[0] - cand[0]) for ref, cand in scores]
+    report = {'mean_abs_delta': statistics.mean(deltas), 'max_abs_delta': max(deltas)}
+    if model_name != 'cimt':
+        report['decision_agreement'] = sum(ref[1] == cand[1] for ref, cand in scores) / len(scores)
+    return report
+
+
+def timed_outputs(model_name, model, images, base_models, repeats):
+    model_outputs(model_name, model, images[:2], base_models)  # warm-up
+    timings, outputs = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        outputs = model_outputs(model_name, model, images, base_models)
+        timings.append((time.perf_counter() - start) * 1000.0 / max(1, len(outputs)))
+    return outputs, statistics.median(timings)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=list(main.MODEL_PATHS), choices=list(main.MODEL_PATHS))
+    parser.add_argument('--precisions', nargs='+', default=['bf16', 'int8-dynamic'])
+    parser.add_argument('--images', help='directory with a fixed evaluation image set')
+    parser.add_argument('--count', type=int, default=8, help='number of images to use')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.count)
+    base_models = {}
+    if 'fusion' in args.models:
+        base_models = {name: main.load_model_uncached(name, 'fp32') for name in ('hypertension', 'cimt', 'vessel')}
+
+    report = {'images': len(images), 'models': {}}
+    for model_name in args.models:
+        reference_model = base_models.get(model_name) or main.load_model_uncached(model_name, 'fp32')
+        reference, reference_ms = timed_outputs(model_name, reference_model, images, base_models, args.repeats)
+        results = {'fp32': {'ms_per_item': reference_ms}}
+        print(f"{model_name}: fp32 {reference_ms:.1f} ms/item")
+
+        for precision in args.precisions:
+            precision = main.normalize_precision(precision)
+            candidate_model = main.load_model_uncached(model_name, precision)
+            candidate, candidate_ms = timed_outputs(model_name, candidate_model, images, base_models, args.repeats)
+            entry = compare(model_name, reference, candidate)
+            entry['ms_per_item'] = candidate_ms
+            entry['speedup'] = reference_ms / candidate_ms if candidate_ms else None
+            results[precision] = entry
+            print(f"  {precision:13s} " + "  ".join(
+                f"{key}={value:.4g}" for key, value in entry.items() if value is not None))
+            del candidate_model
+
+        report['models'][model_name] = results
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,118 @@
+"""
+Benchmark image preprocessing.
+
+Compares the previous preprocess_image / preprocess_image_512 (decode per
+model input, resize before RGB conversion, several full-size float
+temporaries) with the current engine (decode once, normalize straight into the
+output buffer), for a 224 input, a 512 input and both at once as the
+multi-model paths need. Uses synthetic JPEG uploads.
+
+    python -m benchmarks.preprocess --size 3000 --repeats 20
+    python -m benchmarks.preprocess --draft-decode
+
+The engine runs with JPEG_DRAFT_DECODE off by default, so the comparison
+shows what decoding once and normalizing in place gain on their own;
+--draft-decode adds reduced-scale JPEG decoding to the engine's timings.
+Allocations are measured with tracemalloc, which sees numpy buffers but not
+PIL's internal image memory (the same for both paths).
+"""
+import argparse
+import io
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from PIL import Image
+
+import main
+from benchmarks.synthetic import fundus_jpeg
+
+
+def legacy_preprocess(image, target_size=(224, 224)):
+    """preprocess_image as it was before the preprocessing engine"""
+    image = image.resize(target_size, Image.BICUBIC)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    img_array = np.array(image).astype(np.float32) / 255.0
+    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    img_array = (img_array - mean) / std
+    return torch.from_numpy(img_array).permute(2, 0, 1).unsqueeze(0).float()
+
+
+def legacy_preprocess_512(image):
+    """preprocess_image_512 as it was before the preprocessing engine"""
+    image = image.resize((512, 512), Image.BICUBIC)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    img_array = np.array(image).astype(np.float32) / 255.0
+    return torch.from_numpy(img_array).permute(2, 0, 1).unsqueeze(0).float()
+
+
+def legacy(image_bytes, sizes):
+    # Every model input decoded the upload again
+    outputs = {}
+    for size in sizes:
+        image = Image.open(io.BytesIO(image_bytes))
+        outputs[size] = legacy_preprocess_512(image) if size == 512 else legacy_preprocess(image, (size, size))
+    return outputs
+
+
+def engine(image_bytes, sizes):
+    return main.decode_and_preprocess_variants(image_bytes, sizes)[0]
+
+
+def measure(fn, image_bytes, sizes, repeats, warmup):
+    for _ in range(warmup):
+        fn(image_bytes, sizes)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(image_bytes, sizes)
+        timings.append((time.perf_counter() - start) * 1000.0)
+
+    tracemalloc.start()
+    outputs = fn(image_bytes, sizes)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Bytes that are not the returned tensors themselves: temporaries
+    output_bytes = sum(tensor.numel() * tensor.element_size() for tensor in outputs.values())
+    return timings, peak, peak - output_bytes
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=2048, help='Side of the synthetic upload in pixels')
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--draft-decode', action='store_true',
+                        help='Let the engine decode JPEGs at reduced DCT scale (JPEG_DRAFT_DECODE)')
+    args = parser.parse_args()
+
+    image_bytes = fundus_jpeg((args.size, args.size), seed=0, quality=args.quality)
+
+    # With full-resolution decoding the engine must agree with the old
+    # functions up to float rounding. Draft decoding legitimately changes the
+    # pixels, so the check always runs without it.
+    main.JPEG_DRAFT_DECODE = False
+    reference = legacy(image_bytes, (224, 512))
+    current = engine(image_bytes, (224, 512))
+    max_diff = max((reference[size] - current[size]).abs().max().item() for size in (224, 512))
+    main.JPEG_DRAFT_DECODE = args.draft_decode
+
+    print(f"Preprocessing a {args.size}x{args.size} JPEG ({len(image_bytes) / 1024:.0f} KiB), "
+          f"JPEG draft decoding {'on' if args.draft_decode else 'off'}")
+    for sizes in ((224,), (512,), (224, 512)):
+        label = '+'.join(str(size) for size in sizes)
+        for name, fn in (('legacy', legacy), ('engine', engine)):
+            timings, peak, temporaries = measure(fn, image_bytes, sizes, args.repeats, args.warmup)
+            print(f"  {label:>8} {name}: median {statistics.median(timings):7.1f} ms  "
+                  f"peak allocated {peak / 2 ** 20:6.2f} MiB  beyond outputs {temporaries / 2 ** 20:6.2f} MiB")
+    print(f"  max abs difference from legacy (full-resolution decode): {max_diff:.2e}")
+
+
+if __name__ == '__main__':
+    main_cli()
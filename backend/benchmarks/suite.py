@@ -0,0 +1,380 @@
+"""
+Benchmark suite for the models and the /predict endpoint.
+
+Runs without checkpoints or network access: the models are built with random
+weights (SYNTHETIC_MODELS=1, see main.py) and the inputs are synthetic fundus
+photographs (benchmarks.synthetic). The result and embedding caches are off
+so every call does the full work. Measures:
+
+- decode + preprocessing latency per upload resolution;
+- latency percentiles (p50/p95/p99) of each predict_*_batch function;
+- their throughput per batch size and torch thread count;
+- latency and concurrent throughput of POST /predict, through an in-process
+  ASGI client (no server, no sockets);
+- peak RSS of each predict_* function and of /predict, each in a fresh
+  subprocess so the numbers do not include the other models.
+
+Results are written as JSON; --compare prints the change of every metric
+against an earlier run and exits with 1 when one regressed beyond
+--threshold.
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --models hypertension vessel --batch-sizes 1 4 --threads 1 2
+    python -m benchmarks.suite --output new.json --compare bench.json --threshold 0.1
+"""
+import os
+
+# Random-weight models and no caching, unless set explicitly
+os.environ.setdefault('SYNTHETIC_MODELS', '1')
+os.environ.setdefault('RESULT_CACHE_MB', '0')
+os.environ.setdefault('EMBEDDING_CACHE_MB', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+import torch
+
+import main
+from benchmarks.synthetic import fundus_jpeg
+
+# Upload side lengths in pixels; fundus cameras produce 1500-4000 px images
+IMAGE_SIZES = (512, 1024, 2048, 3072)
+
+
+def latency_summary(timings_ms) -> dict:
+    """p50/p95/p99, mean and extremes of a list of millisecond timings"""
+    ordered = sorted(timings_ms)
+
+    def percentile(q):
+        # Linear interpolation between closest ranks
+        position = (len(ordered) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    return {
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'mean_ms': statistics.fmean(ordered),
+        'min_ms': ordered[0],
+        'max_ms': ordered[-1],
+        'samples': len(ordered),
+    }
+
+
+def time_calls(fn, repeats: int, warmup: int):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return timings
+
+
+def uploads_for(model_name: str, image_size: int, seed: int = 0):
+    """Synthetic JPEG uploads for a model: (image,) or (left, right)"""
+    count = len(main.MODEL_INPUT_SIZES[model_name])
+    return [fundus_jpeg((image_size, image_size), seed=seed + eye) for eye in range(count)]
+
+
+def model_inputs(model_name: str, batch_size: int, image_size: int):
+    """Preprocessed input batches for a model's predict_*_batch function"""
+    rows = [
+        [main.decode_and_preprocess(upload, size)[0]
+         for upload, size in zip(uploads_for(model_name, image_size, seed=2 * i), main.MODEL_INPUT_SIZES[model_name])]
+        for i in range(batch_size)
+    ]
+    return [torch.cat([row[eye] for row in rows]) for eye in range(len(rows[0]))]
+
+
+def predict_function(model_name: str):
+    """The predict_*_batch call for a model, as fn(*inputs)"""
+    models = [main.load_model(name) for name in main.MODEL_DEPENDENCIES[model_name]]
+    if model_name == 'hypertension':
+        return lambda image: main.predict_hypertension_batch(models[0], image)
+    if model_name == 'cimt':
+        return lambda left, right: main.predict_cimt_batch(models[0], left, right)
+    if model_name == 'vessel':
+        return lambda image: main.predict_vessel_batch(models[0], image)
+    return lambda left, right: main.predict_fusion_batch(left, right, *models)
+
+
+def bench_preprocess(image_sizes, repeats: int, warmup: int) -> dict:
+    results = {}
+    for image_size in image_sizes:
+        upload = fundus_jpeg((image_size, image_size), seed=0)
+        timings = time_calls(lambda: main.decode_and_preprocess_variants(upload, (224, 512)), repeats, warmup)
+        results[f'{image_size}px'] = {'upload_kib': len(upload) / 1024.0, **latency_summary(timings)}
+        print(f"  preprocess {image_size}px: p50 {results[f'{image_size}px']['p50_ms']:.1f} ms")
+    return results
+
+
+def bench_model(model_name: str, image_size: int, batch_sizes, thread_counts, repeats: int, warmup: int) -> dict:
+    predict = predict_function(model_name)
+    single = model_inputs(model_name, 1, image_size)
+    default_threads = torch.get_num_threads()
+    result = {'latency': latency_summary(time_calls(lambda: predict(*single), repeats, warmup)), 'throughput': {}}
+    print(f"  predict_{model_name}_batch: p50 {result['latency']['p50_ms']:.1f} ms, "
+          f"p99 {result['latency']['p99_ms']:.1f} ms")
+
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                inputs = model_inputs(model_name, batch_size, image_size)
+                timings = time_calls(lambda: predict(*inputs), max(1, repeats // 2), 1)
+                batch_ms = statistics.median(timings)
+                result['throughput'][f'batch{batch_size}_threads{threads}'] = {
+                    'batch_ms': batch_ms,
+                    'items_per_s': 1000.0 * batch_size / batch_ms,
+                }
+                print(f"    batch {batch_size:3d}, {threads} threads: {1000.0 * batch_size / batch_ms:7.2f} items/s")
+    finally:
+        torch.set_num_threads(default_threads)
+    return result
+
+
+async def post_predict(client: httpx.AsyncClient, model_name: str, uploads):
+    if len(uploads) == 2:
+        files = {'left_image': ('left.jpg', uploads[0], 'image/jpeg'),
+                 'right_image': ('right.jpg', uploads[1], 'image/jpeg')}
+    else:
+        files = {'image': ('image.jpg', uploads[0], 'image/jpeg')}
+    response = await client.post('/predict', data={'model': model_name}, files=files)
+    response.raise_for_status()
+    return response
+
+
+def asgi_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://bench', timeout=None)
+
+
+async def _bench_endpoint(model_name: str, image_size: int, repeats: int, warmup: int,
+                          concurrency: int) -> dict:
+    uploads = uploads_for(model_name, image_size)
+    async with asgi_client() as client:
+        for _ in range(warmup):
+            await post_predict(client, model_name, uploads)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            await post_predict(client, model_name, uploads)
+            timings.append((time.perf_counter() - start) * 1000.0)
+
+        # Concurrent clients exercise the micro-batcher and the worker pools
+        total = max(concurrency, repeats)
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await post_predict(client, model_name, uploads)
+
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+    return {
+        'latency': latency_summary(timings),
+        'concurrency': concurrency,
+        'requests_per_s': total / elapsed,
+    }
+
+
+def bench_endpoint(model_name: str, image_size: int, repeats: int, warmup: int, concurrency: int) -> dict:
+    result = asyncio.run(_bench_endpoint(model_name, image_size, repeats, warmup, concurrency))
+    print(f"  /predict {model_name}: p50 {result['latency']['p50_ms']:.1f} ms, "
+          f"{result['requests_per_s']:.2f} req/s at concurrency {concurrency}")
+    return result
+
+
+def _proc_status_mb(field: str):
+    """A memory field of /proc/self/status (e.g. VmRSS) in MiB, None off Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _current_rss_mb() -> float:
+    return _proc_status_mb('VmRSS') or _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    # VmHWM starts over in a new process; ru_maxrss (KiB on Linux) can carry
+    # the parent's peak across exec
+    return _proc_status_mb('VmHWM') or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _memory_child(kind: str, model_name: str, image_size: int, results):
+    """Subprocess body: load the model(s), then run one predict_* call or /predict request"""
+    if kind == 'function':
+        predict = predict_function(model_name)
+        inputs = model_inputs(model_name, 1, image_size)
+        loaded = _current_rss_mb()
+        predict(*inputs)
+    else:
+        for name in main.MODEL_DEPENDENCIES[model_name]:
+            main.load_model(name)
+        uploads = uploads_for(model_name, image_size)
+        loaded = _current_rss_mb()
+
+        async def request():
+            async with asgi_client() as client:
+                await post_predict(client, model_name, uploads)
+
+        asyncio.run(request())
+    results.put({'loaded_rss_mb': loaded, 'peak_rss_mb': _peak_rss_mb()})
+
+
+def measure_peak_rss(kind: str, model_name: str, image_size: int) -> dict:
+    """RSS after loading and peak RSS of one call, in a fresh spawned process"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_memory_child, args=(kind, model_name, image_size, results))
+    process.start()
+    try:
+        result = results.get(timeout=1800)
+    finally:
+        process.join()
+    print(f"  {kind} {model_name}: {result['loaded_rss_mb']:.0f} MiB loaded, "
+          f"peak {result['peak_rss_mb']:.0f} MiB")
+    return result
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(main.__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'synthetic_models': main.SYNTHETIC_MODELS,
+        'precisions': {name: main.model_precision(name) for name in main.MODEL_PATHS},
+    }
+
+
+# ==================== COMPARISON ====================
+
+def flatten(report: dict, prefix: str = '') -> dict:
+    """Numeric leaves of a report as {'results.models.cimt.latency.p50_ms': value}"""
+    values = {}
+    for key, value in report.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def higher_is_better(path: str):
+    """True/False for throughput/latency-like metrics, None for the rest"""
+    name = path.rsplit('.', 1)[-1]
+    if name.endswith('_per_s'):
+        return True
+    if name.endswith('_ms') or name.endswith('_mb'):
+        return False
+    return None
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float):
+    """Print the relative change of every shared metric; returns the regressed paths"""
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    regressions = []
+    print(f"\nChange against {baseline['environment'].get('timestamp')} "
+          f"(commit {baseline['environment'].get('commit') or 'unknown'}):")
+    for path in sorted(old.keys() & new.keys()):
+        direction = higher_is_better(path)
+        if direction is None or not old[path]:
+            continue
+        change = (new[path] - old[path]) / old[path]
+        regressed = (change < -threshold) if direction else (change > threshold)
+        improved = (change > threshold) if direction else (change < -threshold)
+        marker = 'REGRESSION' if regressed else ('improved' if improved else '')
+        print(f"  {path:70s} {old[path]:12.2f} -> {new[path]:12.2f} {change:+7.1%} {marker}")
+        if regressed:
+            regressions.append(path)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', choices=list(main.MODEL_PATHS), default=list(main.MODEL_PATHS))
+    parser.add_argument('--image-size', type=int, default=2048, help='Upload side length for the model benchmarks')
+    parser.add_argument('--preprocess-sizes', type=int, nargs='+', default=list(IMAGE_SIZES))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                        help='torch intra-op thread counts for the throughput sweep')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent /predict clients')
+    parser.add_argument('--skip', nargs='+', default=[], choices=['preprocess', 'functions', 'endpoint', 'memory'])
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='Earlier --output file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative change counted as a regression (default 0.10)')
+    args = parser.parse_args()
+
+    results = {}
+    if 'preprocess' not in args.skip:
+        print("Decode + preprocessing")
+        results['preprocess'] = bench_preprocess(args.preprocess_sizes, args.repeats, args.warmup)
+    if 'functions' not in args.skip:
+        print(f"predict_* functions ({args.image_size}px uploads)")
+        results['functions'] = {
+            name: bench_model(name, args.image_size, args.batch_sizes, args.threads, args.repeats, args.warmup)
+            for name in args.models
+        }
+    if 'endpoint' not in args.skip:
+        print("POST /predict (in-process ASGI)")
+        results['endpoint'] = {
+            name: bench_endpoint(name, args.image_size, args.repeats, args.warmup, args.concurrency)
+            for name in args.models
+        }
+    if 'memory' not in args.skip:
+        print("Peak RSS (one subprocess per measurement)")
+        results['memory'] = {
+            kind: {name: measure_peak_rss(kind, name, args.image_size) for name in args.models}
+            for kind in ('function', 'endpoint')
+        }
+
+    report = {'environment': environment(), 'arguments': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(json.load(f), report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
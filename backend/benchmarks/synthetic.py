@@ -0,0 +1,67 @@
+"""
+Synthetic, fundus-like test images.
+
+The images are deterministic for a given seed and size: a dark background
+with an orange-red retinal disc, a bright optic disc, branching dark vessels
+and some sensor noise. They need no patient data.
+"""
+import io
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def fundus_image(size=(512, 512), seed: int = 0) -> Image.Image:
+    """Generate one synthetic fundus photograph as an RGB PIL image"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    radius = 0.46 * min(width, height)
+    cx, cy = width / 2.0, height / 2.0
+
+    # Retinal disc with darker periphery
+    yy, xx = np.ogrid[0:height, 0:width]
+    dist = np.hypot(xx - cx, yy - cy) / radius
+    shade = np.clip(1.0 - 0.6 * dist ** 2, 0.0, 1.0) * (dist < 1.0)
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    for channel, level in enumerate((205.0, 95.0, 45.0)):
+        pixels[..., channel] = level * shade
+
+    # Optic disc on the left or right of the centre
+    side = 1 if seed % 2 else -1
+    ox = cx + side * 0.45 * radius
+    oy = cy + rng.uniform(-0.1, 0.1) * radius
+    disc = np.exp(-((xx - ox) ** 2 + (yy - oy) ** 2) / (2.0 * (0.08 * radius) ** 2))
+    for channel, level in enumerate((50.0, 120.0, 100.0)):
+        pixels[..., channel] += level * disc
+
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), mode='RGB')
+
+    # Vessels: slightly curved branches leaving the optic disc
+    draw = ImageDraw.Draw(image)
+    line_scale = max(1.0, min(width, height) / 512.0)
+    for _ in range(14):
+        angle = rng.uniform(0.0, 2.0 * math.pi)
+        bend = rng.uniform(-1.5, 1.5)
+        length = rng.uniform(0.6, 1.3) * radius
+        points = []
+        for step in range(41):
+            t = step / 40.0
+            theta = angle + bend * t * t
+            points.append((ox + t * length * math.cos(theta), oy + t * length * math.sin(theta)))
+        thickness = int(rng.uniform(2.0, 5.0) * line_scale)
+        draw.line(points, fill=(120, 25, 20), width=thickness)
+
+    # Sensor noise; everything outside the retinal disc stays black
+    pixels = np.asarray(image, dtype=np.int16)
+    noise = rng.normal(0.0, 4.0, size=pixels.shape).astype(np.int16)
+    pixels = np.clip(pixels + noise, 0, 255) * (dist < 1.0)[..., None]
+    pixels = pixels.astype(np.uint8)
+    return Image.fromarray(pixels, mode='RGB')
+
+
+def fundus_jpeg(size=(512, 512), seed: int = 0, quality: int = 90) -> bytes:
+    """Synthetic fundus photograph encoded as JPEG bytes, like a camera upload"""
+    buffer = io.BytesIO()
+    fundus_image(size, seed).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,146 @@
+"""
+Export the models as compiled TorchScript artifacts.
+
+Each model is loaded eagerly, traced into a single graph that returns its
+prediction and embedding, and frozen. The saved artifact is then loaded back
+the way load_model loads it and checked against the eager model on random
+inputs. Artifacts go to COMPILED_MODEL_DIR (see main.py) and are picked up by
+load_model on the next start; an artifact whose outputs drift beyond the
+tolerance is not written.
+
+    python export_models.py
+    python export_models.py --models hypertension vessel --precisions fp32 bf16
+
+Artifacts are tied to the checkpoint version and precision, so they are
+ignored (and removed on the next export) when a checkpoint changes.
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+import main
+
+# Largest allowed absolute difference from eager, per precision
+TOLERANCES = {'fp32': 1e-3, 'bf16': 5e-2, 'int8-dynamic': 1e-2}
+
+
+def example_inputs(model_name, batch_size, size, device, dtype, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    if model_name == 'fusion':
+        return (torch.randn(batch_size, 1425, generator=generator).to(device=device, dtype=dtype),)
+    image = lambda: torch.randn(batch_size, 3, size, size, generator=generator).to(device=device, dtype=dtype)
+    if model_name == 'cimt':
+        clinical = main.dummy_clinical_features(batch_size).to(device=device, dtype=dtype)
+        return image(), image(), clinical
+    return (image(),)
+
+
+def parity_cases(model_name):
+    """(batch size, image size) pairs the compiled graph is checked at"""
+    if model_name == 'fusion':
+        return [(1, None), (3, None)]
+    if model_name == 'hypertension':
+        return [(1, 224), (3, 224)]
+    if model_name == 'vessel':
+        # Tiled segmentation feeds VESSEL_TILE_SIZE tiles, which need not be 512
+        return [(1, 512), (3, 512), (2, 256), (1, 768)]
+    # /predict feeds 512 inputs, the fusion path 224 ones
+    return [(1, 512), (3, 512), (2, 224)]
+
+
+def max_difference(eager_outputs, compiled_outputs):
+    if isinstance(eager_outputs, torch.Tensor):
+        eager_outputs, compiled_outputs = (eager_outputs,), (compiled_outputs,)
+    return max(
+        (expected.float() - actual.float()).abs().max().item()
+        for expected, actual in zip(eager_outputs, compiled_outputs)
+    )
+
+
+def compile_model(model_name, model):
+    adapter = main.TraceAdapter(model_name, model).eval()
+    device, dtype = main.model_input_spec(model)
+    batch_size, size = parity_cases(model_name)[0]
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, example_inputs(model_name, batch_size, size, device, dtype))
+        try:
+            compiled = torch.jit.freeze(traced)
+        except Exception as e:
+            # Quantized packed params are not always freezable; keep the trace
+            print(f"  {model_name}: freeze skipped ({e})")
+            compiled = traced
+    return adapter, compiled
+
+
+def check_parity(model_name, adapter, compiled, precision):
+    """Compare a reloaded artifact (main.CompiledModel) with the eager model"""
+    device, dtype = main.model_input_spec(adapter.model)
+    worst = 0.0
+    with torch.no_grad():
+        for seed, (batch_size, size) in enumerate(parity_cases(model_name), start=1):
+            inputs = example_inputs(model_name, batch_size, size, device, dtype, seed)
+            worst = max(worst, max_difference(adapter(*inputs), compiled.module(*inputs)))
+    return worst, worst <= TOLERANCES[precision]
+
+
+def remove_stale_artifacts(model_name, precision, keep_path):
+    if not os.path.isdir(main.COMPILED_MODEL_DIR):
+        return
+    suffix = f"-{precision}.ts"
+    for entry in os.listdir(main.COMPILED_MODEL_DIR):
+        path = os.path.join(main.COMPILED_MODEL_DIR, entry)
+        if entry.startswith(f"{model_name}-") and entry.endswith(suffix) and path != keep_path:
+            os.remove(path)
+
+
+def export(model_name, precision):
+    model = main.load_model_uncached(model_name, precision, use_compiled=False)
+    adapter, compiled = compile_model(model_name, model)
+
+    # Check exactly what load_model will run: the saved file, reloaded
+    path = main.compiled_artifact_path(model_name, precision)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    torch.jit.save(compiled, tmp_path)
+    device, _ = main.model_input_spec(model)
+    reloaded = main.load_compiled_model(model_name, precision, device, path=tmp_path)
+    if reloaded is None:
+        os.remove(tmp_path)
+        print(f"  {model_name} [{precision}]: saved artifact could not be loaded back")
+        return False
+
+    worst, ok = check_parity(model_name, adapter, reloaded, precision)
+    print(f"  {model_name} [{precision}]: max |compiled - eager| = {worst:.2e} "
+          f"(tolerance {TOLERANCES[precision]:.0e})")
+    if not ok:
+        os.remove(tmp_path)
+        print(f"  {model_name} [{precision}]: parity check failed, artifact not written")
+        return False
+
+    os.replace(tmp_path, path)
+    remove_stale_artifacts(model_name, precision, path)
+    print(f"  {model_name} [{precision}]: wrote {path}")
+    return True
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', choices=list(main.MODEL_PATHS), default=list(main.MODEL_PATHS))
+    parser.add_argument('--precisions', nargs='+', choices=list(main.PRECISIONS),
+                        help="Default: each model's configured precision")
+    args = parser.parse_args()
+
+    failed = []
+    for model_name in args.models:
+        for precision in args.precisions or [main.model_precision(model_name)]:
+            if not export(model_name, precision):
+                failed.append(f"{model_name} [{precision}]")
+    if failed:
+        print(f"Parity check failed for: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
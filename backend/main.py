@@ -12,10 +12,73 @@ from typing import Optional, Union
 import base64
 import timm
 import os
+import urllib.error
 import urllib.request
+import hashlib
+import itertools
+import json
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+# Logs are one JSON object per line (LOG_FORMAT=json) or plain text with
+# key=value fields (LOG_FORMAT=text), at LOG_LEVEL. Pass structured fields as
+# extra=log_fields(name=value, ...).
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+logger = logging.getLogger('cvd_risk')
+
+
+class LogFormatter(logging.Formatter):
+    """Formats records with their structured fields as JSON lines or text"""
+    def __init__(self, json_lines: bool = True):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_lines:
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = f"{self.formatTime(record)} {record.levelname} {record.getMessage()}"
+        line += ''.join(f" {name}={value}" for name, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def log_fields(**fields) -> dict:
+    return {'fields': fields}
+
+
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(LogFormatter(json_lines=LOG_FORMAT != 'text'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
 
 app = FastAPI(title="CVD Risk Predictor API")
 
+# Response headers browsers may read cross-origin: the png and packbits vessel
+# formats carry their features and mask shape only in headers
+EXPOSED_HEADERS = ["X-Vessel-Features", "X-Mask-Shape", "Server-Timing", "Retry-After"]
+
 # Add CORS headers to all responses (workaround for HF Spaces)
 @app.middleware("http")
 async def add_cors_header(request, call_next):
@@ -23,6 +86,7 @@ async def add_cors_header(request, call_next):
     response.headers["Access-Control-Allow-Origin"] = "*"
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
     response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers["Access-Control-Expose-Headers"] = ", ".join(EXPOSED_HEADERS)
     return response
 
 # Serve static frontend files (for Hugging Face Space deployment)
@@ -37,17 +101,8 @@ if os.path.exists(static_dir):
         if os.path.exists(index_path):
             return FileResponse(index_path)
         return {"error": "Frontend not found"}
-    
-    @app.get("/{full_path:path}")
-    async def serve_frontend(full_path: str):
-        # Don't intercept API routes
-        if full_path.startswith("api") or full_path.startswith("predict") or full_path.startswith("health"):
-            raise HTTPException(status_code=404, detail="Not found")
-        # Serve index.html for React Router
-        index_path = os.path.join(static_dir, "index.html")
-        if os.path.exists(index_path):
-            return FileResponse(index_path)
-        raise HTTPException(status_code=404, detail="Frontend not found")
+    # The React Router catch-all is registered at the bottom of this file so
+    # that it does not shadow the API routes.
 
 # CORS middleware - Allow all origins for public API
 app.add_middleware(
@@ -56,6 +111,7 @@ app.add_middleware(
     allow_credentials=False,  # Must be False when using "*"
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=EXPOSED_HEADERS,
 )
 
 # Model paths - check for Netlify Functions / custom MODEL_DIR environment
@@ -88,11 +144,90 @@ MODEL_URLS = {
 models = {}
 
 
+def _env_number(name: str, default, cast=int):
+    """Read a numeric setting from the environment"""
+    value = os.environ.get(name, '')
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValueError(f"Environment variable {name} must be a number, got '{value}'")
+
+
+# Downloads stream to "<model path>.part" in DOWNLOAD_CHUNK_SIZE chunks and are
+# renamed into place only once complete (and verified), so a crash never
+# leaves a truncated checkpoint behind. An existing .part file is resumed with
+# an HTTP Range request. Expected SHA-256 digests come from
+# <NAME>_MODEL_SHA256 (e.g. FUSION_MODEL_SHA256) or from a JSON manifest at
+# MODEL_MANIFEST mapping model names or file names to hex digests.
+DOWNLOAD_CHUNK_SIZE = _env_number('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+DOWNLOAD_RETRIES = max(1, _env_number('DOWNLOAD_RETRIES', 3))
+DOWNLOAD_TIMEOUT = _env_number('DOWNLOAD_TIMEOUT', 60.0, float)
+MODEL_MANIFEST = os.environ.get('MODEL_MANIFEST', '')
+
+
+def expected_sha256(model_name: str) -> Optional[str]:
+    """Expected SHA-256 of a model file, if one is configured"""
+    digest = os.environ.get(f'{model_name.upper()}_MODEL_SHA256', '')
+    if not digest and MODEL_MANIFEST:
+        with open(MODEL_MANIFEST) as f:
+            manifest = json.load(f)
+        filename = os.path.basename(MODEL_PATHS[model_name])
+        digest = manifest.get(model_name) or manifest.get(filename) or ''
+    return digest.strip().lower() or None
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stream_download(url: str, part_path: str):
+    """Stream url into part_path, resuming after whatever part_path already holds"""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            # Nothing left to fetch; the checksum (if any) decides whether it is intact
+            return
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            logger.warning("Server ignored the Range request, restarting download", extra=log_fields(url=url))
+            offset = 0
+        remaining = response.headers.get('Content-Length')
+        expected_size = offset + int(remaining) if remaining is not None else None
+
+        with open(part_path, 'ab' if offset else 'wb') as out_file:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out_file.write(chunk)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(f"download incomplete: got {size} of {expected_size} bytes")
+
+
 def ensure_model_file(model_name: str) -> str:
     """
     Ensure the model file exists locally.
     - If it exists on disk: return the path.
-    - If not, and a MODEL_URL is configured: download it once.
+    - If not, and a MODEL_URL is configured: download it once (streamed,
+      resumable, checksum-verified when a digest is configured).
     """
     model_path = MODEL_PATHS.get(model_name)
     if not model_path:
@@ -113,19 +248,308 @@ def ensure_model_file(model_name: str) -> str:
 
     # Make sure directory exists
     os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    part_path = model_path + '.part'
 
-    # Download the file
-    try:
-        print(f"Downloading model '{model_name}' from {url} ...")
-        with urllib.request.urlopen(url) as response, open(model_path, "wb") as out_file:
-            out_file.write(response.read())
-        print(f"Downloaded model '{model_name}' to {model_path}")
-    except Exception as e:
-        raise RuntimeError(f"Failed to download model '{model_name}' from {url}: {e}")
+    # Download the file, resuming the partial file after a failure
+    logger.info("Downloading model", extra=log_fields(model=model_name, url=url))
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            _stream_download(url, part_path)
+            break
+        except Exception as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise RuntimeError(f"Failed to download model '{model_name}' from {url}: {e}")
+            logger.warning("Model download interrupted, resuming", extra=log_fields(
+                model=model_name, error=str(e), attempt=attempt + 1, attempts=DOWNLOAD_RETRIES
+            ))
+            time.sleep(min(2 ** attempt, 10))
+
+    digest = expected_sha256(model_name)
+    if digest:
+        actual = sha256_file(part_path)
+        if actual != digest:
+            os.remove(part_path)
+            raise RuntimeError(
+                f"Checksum mismatch for model '{model_name}' from {url}: "
+                f"expected {digest}, got {actual}"
+            )
 
+    os.replace(part_path, model_path)
+    logger.info("Downloaded model", extra=log_fields(model=model_name, path=model_path))
     return model_path
 
 
+def ensure_model_files(model_names=None) -> dict:
+    """Download any missing model files concurrently; returns name -> path"""
+    model_names = list(model_names or MODEL_PATHS)
+    with ThreadPoolExecutor(max_workers=len(model_names), thread_name_prefix="download") as executor:
+        return dict(zip(model_names, executor.map(ensure_model_file, model_names)))
+
+
+# ==================== METRICS ====================
+# Every request gets per-stage timing spans (upload parsing, decode,
+# preprocessing, model loading, queueing, inference and each fusion base
+# model, mask encoding, ...). Spans feed the cvd_stage_duration_seconds
+# Prometheus histogram (labelled by model and stage) served at GET /metrics,
+# and the stages of one request are returned in its Server-Timing header.
+# Work done on executors or batcher threads collects its spans locally
+# (collect_spans) and hands them back to the request that submitted it.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+_metrics = []
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_sample(name: str, labels, value) -> str:
+    label_text = ','.join(f'{label}="{_escape_label(v)}"' for label, v in labels)
+    value = float(value)
+    value_text = '+Inf' if value == float('inf') else repr(value)
+    return f"{name}{{{label_text}}} {value_text}" if label_text else f"{name} {value_text}"
+
+
+class Metric:
+    """Prometheus metric with named labels, rendered in the text exposition format"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """(sample name, ((label, value), ...), value) tuples"""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(_format_sample(*sample) for sample in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in sorted(items):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels + (('le', repr(float(bound))),), cumulative
+            yield f"{self.name}_bucket", labels + (('le', '+Inf'),), count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class CollectedMetric(Metric):
+    """Gauge or counter read at scrape time from collect() -> {label values: value}"""
+    def __init__(self, name: str, help_text: str, kind: str, labelnames, collect):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+STAGE_SECONDS = Histogram(
+    'cvd_stage_duration_seconds', 'Time spent in each stage of a prediction', ('model', 'stage')
+)
+REQUEST_SECONDS = Histogram(
+    'cvd_request_duration_seconds', 'Prediction request latency', ('endpoint', 'model')
+)
+REQUESTS = Counter(
+    'cvd_requests_total', 'Prediction requests by response status', ('endpoint', 'model', 'status')
+)
+ERRORS = Counter(
+    'cvd_errors_total', 'Failed prediction requests by error type', ('endpoint', 'model', 'type')
+)
+MODEL_LOADS = Counter('cvd_model_loads_total', 'Model loads by outcome', ('model', 'outcome'))
+MODEL_LOAD_SECONDS = Histogram('cvd_model_load_duration_seconds', 'Time to load a model', ('model',))
+MODEL_RELOAD_SECONDS = Histogram(
+    'cvd_model_reload_duration_seconds', 'Time to reload a model evicted from memory', ('model',)
+)
+BATCH_SIZES = Histogram(
+    'cvd_batch_size', 'Requests per batched forward pass', ('model',), buckets=BATCH_SIZE_BUCKETS
+)
+
+# Stage timings of the request being handled, set by RequestTimingMiddleware
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_span_collector = threading.local()
+
+
+class RequestTimings:
+    """Stage durations and log fields of one HTTP request"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    def add(self, stage: str, seconds: float, model: str = ''):
+        # Stages of other models than the request's (e.g. in /predict/multi)
+        # are reported as "<model>.<stage>"
+        if model and model != self.fields.get('model'):
+            stage = f"{model}.{stage}"
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        entries = [f"{stage};dur={seconds * 1000.0:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={total * 1000.0:.1f}")
+        return ', '.join(entries)
+
+
+def record_stage(stage: str, seconds: float, model: str = ''):
+    """Record a stage duration for the metrics and the current request.
+
+    model defaults to the request's model. Inside collect_spans the span is
+    kept for the caller to record instead.
+    """
+    spans = getattr(_span_collector, 'spans', None)
+    if spans is not None:
+        spans.append((stage, seconds, model))
+        return
+    timings = _request_timings.get()
+    if timings is not None:
+        model = model or timings.fields.get('model', '')
+        timings.add(stage, seconds, model)
+    STAGE_SECONDS.observe(seconds, model=model, stage=stage)
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str, model: str = ''):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, model)
+
+
+def collect_spans(fn, *args):
+    """Run fn(*args) and return (result, spans) with the stages it timed.
+
+    For work running on executors (including process pools) and batcher
+    threads, whose spans belong to the request that submitted it.
+    """
+    previous = getattr(_span_collector, 'spans', None)
+    _span_collector.spans = spans = []
+    try:
+        return fn(*args), spans
+    finally:
+        _span_collector.spans = previous
+
+
+def record_spans(spans, model: str = ''):
+    """Record spans from collect_spans, labelling unlabelled ones with model"""
+    for stage, seconds, span_model in spans:
+        record_stage(stage, seconds, span_model or model)
+
+
+def annotate_request(**fields):
+    """Attach fields (e.g. model, cache) to the current request's metrics and log line"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.fields.update(fields)
+
+
+def request_elapsed() -> float:
+    """Seconds since the current request arrived, 0.0 outside a request"""
+    timings = _request_timings.get()
+    return time.perf_counter() - timings.started if timings is not None else 0.0
+
+
+# Endpoints whose requests are counted, logged and get a Server-Timing header
+TIMED_ENDPOINTS = ('/predict', '/predict/multi')
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware adding request metrics, a log line and Server-Timing to prediction requests"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] not in TIMED_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                total = time.perf_counter() - timings.started
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', timings.server_timing(total).encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            total = time.perf_counter() - timings.started
+            endpoint, model = scope['path'], timings.fields.get('model', '')
+            REQUESTS.inc(endpoint=endpoint, model=model, status=status)
+            REQUEST_SECONDS.observe(total, endpoint=endpoint, model=model)
+            if status >= 400:
+                error = timings.fields.get('error') or ('busy' if status == 503 else f'http_{status}')
+                ERRORS.inc(endpoint=endpoint, model=model, type=error)
+            logger.info("Prediction request", extra=log_fields(
+                endpoint=endpoint, status=status, duration_ms=round(total * 1000.0, 1),
+                stages={stage: round(seconds * 1000.0, 1) for stage, seconds in timings.stages.items()},
+                **timings.fields,
+            ))
+
+
 # ==================== MODEL ARCHITECTURES ====================
 
 class RETFoundClassifier(nn.Module):
@@ -174,29 +598,36 @@ class UNet(nn.Module):
         self.dec2 = CBR(128+64, 64)
         self.final = nn.Conv2d(64, out_ch, 1)
 
-    def forward(self, x, return_features=False):
+    def forward(self, x, return_features=False, return_embedding=False):
+        """Return mask logits, encoder features only (return_features=True),
+        or both from a single encoder pass (return_embedding=True)."""
         e1 = self.enc1(x)
         e2 = self.enc2(self.pool(e1))
         e3 = self.enc3(self.pool(e2))
         
-        if return_features:
-            # Return learned features from encoder (256 dim after pooling)
+        if return_features or return_embedding:
+            # Learned features from encoder (256 dim after pooling)
             features = torch.nn.functional.adaptive_avg_pool2d(e3, (1, 1)).flatten(1)
-            return features
+            if not return_embedding:
+                return features
         
         d3 = self.up(e3)
         d3 = self.dec3(torch.cat([d3, e2], dim=1))
         d2 = self.up(d3)
         d2 = self.dec2(torch.cat([d2, e1], dim=1))
-        return self.final(d2)
+        logits = self.final(d2)
+        
+        if return_embedding:
+            return logits, features
+        return logits
 
 
 class SiameseMultimodalCIMTRegression(nn.Module):
     """Siamese multimodal model for CIMT regression"""
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super().__init__()
         MODEL_NAME = "seresnext50_32x4d"
-        USE_PRETRAINED = True
+        USE_PRETRAINED = pretrained
         CLINICAL_INPUT_DIM = 3  # age + gender (2)
         CLINICAL_HIDDEN_DIM = 128
         BACKBONE_OUTPUT_DIM = 2048
@@ -236,9 +667,14 @@ class SiameseMultimodalCIMTRegression(nn.Module):
         self.fusion = nn.Sequential(*layers)
 
     def forward(self, left_img, right_img, clinical, return_embedding=False):
-        # Extract features from both eyes (shared weights)
-        left_features = self.backbone(left_img)
-        right_features = self.backbone(right_img)
+        # Extract features from both eyes (shared weights). Both eyes go
+        # through the backbone as one 2N batch and are split afterwards.
+        if left_img.shape == right_img.shape:
+            both_features = self.backbone(torch.cat([left_img, right_img], dim=0))
+            left_features, right_features = both_features.chunk(2, dim=0)
+        else:
+            left_features = self.backbone(left_img)
+            right_features = self.backbone(right_img)
 
         # Concatenate bilateral features
         bilateral_features = torch.cat([left_features, right_features], dim=1)
@@ -288,228 +724,1001 @@ class FusionMetaClassifier(nn.Module):
 
 # ==================== MODEL LOADING ====================
 
-def load_model(model_name: str):
-    """Load a PyTorch model"""
-    if model_name in models:
-        return models[model_name]
-    
-    # Ensure the model file exists locally (download if needed in cloud)
-    model_path = ensure_model_file(model_name)
-    
+# Checkpoints are converted once into a plain state-dict file under
+# MODEL_CACHE_DIR (default: .model_cache next to the model files). Later loads
+# memory-map that file with torch.load(mmap=True) and the modules adopt the
+# mapped tensors directly, so weights are neither unpickled nor copied twice.
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR') or os.path.join(MODEL_DIR or '.', '.model_cache')
+
+
+def build_model(model_name: str) -> nn.Module:
+    """Create the architecture for a model name (weights not loaded)"""
+    if model_name == 'hypertension':
+        return RETFoundClassifier(dropout=0.65)
+    elif model_name == 'vessel':
+        return UNet(in_ch=3, out_ch=1)
+    elif model_name == 'cimt':
+        # ImageNet weights would be overwritten by the checkpoint anyway
+        return SiameseMultimodalCIMTRegression(pretrained=False)
+    elif model_name == 'fusion':
+        # Fusion model is a FusionMetaClassifier
+        return FusionMetaClassifier(
+            input_dim=1425,
+            hidden_dims=[512, 256],
+            dropout=0.3
+        )
+    raise ValueError(f"Unknown model architecture for {model_name}")
+
+
+# SYNTHETIC_MODELS=1 builds every model with random weights from a fixed seed
+# instead of loading its checkpoint, so benchmarks and load tests run offline
+# and without the (large) model files. Predictions are meaningless.
+SYNTHETIC_MODELS = os.environ.get('SYNTHETIC_MODELS', '0') == '1'
+
+
+def build_synthetic_model(model_name: str, seed: int = 0) -> nn.Module:
+    """Architecture for a model name with deterministic random weights"""
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        model = build_model(model_name)
+    return model.eval()
+
+
+def build_model_on_meta(model_name: str) -> nn.Module:
+    """Build a model on the meta device: no memory and no random init for its weights.
+
+    Falls back to a regular CPU build if an architecture cannot be created on meta.
+    """
     try:
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        
-        # Load checkpoint
-        try:
-            loaded_data = torch.load(model_path, map_location=device, weights_only=False)
-        except TypeError:
-            loaded_data = torch.load(model_path, map_location=device)
-        
-        # Check if it's a state dict or full model
-        if isinstance(loaded_data, dict):
-            # Check if it's a checkpoint dict or just state_dict
-            # Try common checkpoint keys in order
-            state_dict = None
-            for key in ['model_state_dict', 'model', 'state_dict', 'weights']:
-                if key in loaded_data and isinstance(loaded_data[key], dict):
-                    state_dict = loaded_data[key]
-                    break
-            
-            # If no checkpoint key found, assume it's a direct state_dict
-            if state_dict is None:
-                state_dict = loaded_data
-            
-            # Create model instance based on model_name
-            if model_name == 'hypertension':
-                model = RETFoundClassifier(dropout=0.65).to(device)
-            elif model_name == 'vessel':
-                model = UNet(in_ch=3, out_ch=1).to(device)
-            elif model_name == 'cimt':
-                model = SiameseMultimodalCIMTRegression().to(device)
-            elif model_name == 'fusion':
-                # Fusion model is a FusionMetaClassifier
-                model = FusionMetaClassifier(
-                    input_dim=1425,
-                    hidden_dims=[512, 256],
-                    dropout=0.3
-                ).to(device)
+        with torch.device('meta'):
+            return build_model(model_name)
+    except Exception as e:
+        logger.warning("Could not build model on the meta device, building on CPU",
+                       extra=log_fields(model=model_name, error=str(e)))
+        return build_model(model_name)
+
+
+def materialize_missing_weights(model: nn.Module) -> list:
+    """Give parameters/buffers the checkpoint did not provide real storage.
+
+    They get the module's default initialisation (reset_parameters) where it
+    has one, zeros otherwise. Returns the names of the affected tensors.
+    """
+    missing = []
+    for module_name, module in model.named_modules():
+        own = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+        meta_names = [name for name, tensor in own if tensor.is_meta]
+        if not meta_names:
+            continue
+        # Swap every tensor of the module for zeroed CPU storage so that
+        # reset_parameters() cannot write into the checkpoint tensors
+        loaded = {name: tensor for name, tensor in own if not tensor.is_meta}
+        for name, tensor in own:
+            placeholder = torch.zeros_like(tensor, device='cpu')
+            if name in module._parameters:
+                module._parameters[name] = nn.Parameter(placeholder, requires_grad=tensor.requires_grad)
             else:
-                raise ValueError(f"Unknown model architecture for {model_name}")
-            
-            # Load state dict
+                module._buffers[name] = placeholder
+        if hasattr(module, 'reset_parameters'):
+            with torch.no_grad():
+                module.reset_parameters()
+        # Put back the tensors that did come from the checkpoint
+        for name, tensor in loaded.items():
+            if name in module._parameters:
+                module._parameters[name] = tensor
+            else:
+                module._buffers[name] = tensor
+        missing.extend(f"{module_name}.{name}" if module_name else name for name in meta_names)
+    return missing
+
+
+def extract_state_dict(loaded_data):
+    """Return the state dict held by a loaded checkpoint, or None for a full model object"""
+    if not isinstance(loaded_data, dict):
+        return None
+    # Check if it's a checkpoint dict or just state_dict
+    # Try common checkpoint keys in order
+    for key in ['model_state_dict', 'model', 'state_dict', 'weights']:
+        if key in loaded_data and isinstance(loaded_data[key], dict):
+            return loaded_data[key]
+    # If no checkpoint key found, assume it's a direct state_dict
+    return loaded_data
+
+
+def checkpoint_version(model_name: str) -> str:
+    """Short identifier of the checkpoint file currently on disk for a model"""
+    if SYNTHETIC_MODELS:
+        return 'synthetic'
+    model_path = MODEL_PATHS[model_name]
+    stat = os.stat(model_path)
+    key = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _write_checkpoint_cache(model_name: str, cache_path: str, state_dict: dict):
+    """Atomically write a state dict to the cache and drop stale versions"""
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Files of other checkpoint versions of this model are stale
+    current = f"{model_name}-{checkpoint_version(model_name)}"
+    for filename in os.listdir(MODEL_CACHE_DIR):
+        path = os.path.join(MODEL_CACHE_DIR, filename)
+        if filename.startswith(f"{model_name}-") and not filename.startswith(current):
             try:
-                model.load_state_dict(state_dict, strict=False)
-            except Exception as e:
-                print(f"Warning: Could not load all weights strictly: {e}")
-                # Try non-strict loading
-                model.load_state_dict(state_dict, strict=False)
-            
-            model.eval()
-            models[model_name] = model
-            return model
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_checkpoint(model_name: str, model_path: str):
+    """Load a checkpoint, memory-mapping its weights from the local cache.
+
+    The first load unpickles the original file and writes its state dict to
+    MODEL_CACHE_DIR; later loads map that file instead. Returns a state dict,
+    or the loaded object for checkpoints that pickle a full model.
+    """
+    cache_path = os.path.join(MODEL_CACHE_DIR, f"{model_name}-{checkpoint_version(model_name)}.pt")
+    if os.path.exists(cache_path):
+        try:
+            return torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+        except Exception as e:
+            logger.warning("Ignoring unreadable checkpoint cache", extra=log_fields(path=cache_path, error=str(e)))
+
+    try:
+        loaded_data = torch.load(model_path, map_location='cpu', weights_only=False)
+    except TypeError:
+        loaded_data = torch.load(model_path, map_location='cpu')
+
+    state_dict = extract_state_dict(loaded_data)
+    if state_dict is None:
+        return loaded_data
+
+    state_dict = {key: value for key, value in state_dict.items() if isinstance(value, torch.Tensor)}
+    try:
+        _write_checkpoint_cache(model_name, cache_path, state_dict)
+    except OSError as e:
+        logger.warning("Could not cache checkpoint", extra=log_fields(
+            model=model_name, cache_dir=MODEL_CACHE_DIR, error=str(e)
+        ))
+        return state_dict
+
+    # Switch to the mapped copy so the unpickled tensors can be freed
+    del loaded_data, state_dict
+    return torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+
+
+# Precision per model: MODEL_PRECISION sets the default and
+# <NAME>_MODEL_PRECISION (e.g. HYPERTENSION_MODEL_PRECISION) overrides it.
+#   fp32          - full precision (default)
+#   bf16          - weights and activations in bfloat16
+#   int8-dynamic  - nn.Linear layers dynamically quantized to int8 (CPU only);
+#                   the quantized weights are cached in MODEL_CACHE_DIR
+# Compare outputs against fp32 before enabling a mode: python -m benchmarks.precision
+PRECISIONS = ('fp32', 'bf16', 'int8-dynamic')
+_PRECISION_ALIASES = {'float32': 'fp32', 'bfloat16': 'bf16', 'int8': 'int8-dynamic'}
+
+
+def normalize_precision(precision: str) -> str:
+    precision = precision.strip().lower()
+    precision = _PRECISION_ALIASES.get(precision, precision)
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+    return precision
+
+
+def model_precision(model_name: str) -> str:
+    """Configured precision for a model"""
+    precision = os.environ.get(f'{model_name.upper()}_MODEL_PRECISION') or os.environ.get('MODEL_PRECISION', 'fp32')
+    return normalize_precision(precision)
+
+
+def _swap_linear_for_quantized(module: nn.Module):
+    """Replace nn.Linear layers by empty dynamic int8 ones, ready for a quantized state dict"""
+    for name, child in module.named_children():
+        if type(child) is nn.Linear:
+            with torch.device('cpu'):
+                quantized = torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features, child.out_features,
+                    bias_=child.bias is not None, dtype=torch.qint8,
+                )
+            setattr(module, name, quantized)
         else:
-            # It's a full model object
-            model = loaded_data
-            model.eval()
-            model.to(device)
-            models[model_name] = model
+            _swap_linear_for_quantized(child)
+
+
+def apply_precision(model: nn.Module, precision: str) -> nn.Module:
+    """Convert a full-precision CPU model to the given precision"""
+    if precision == 'bf16':
+        return model.to(torch.bfloat16)
+    if precision == 'int8-dynamic':
+        if not any(type(module) is nn.Linear for module in model.modules()):
+            # e.g. the UNet is all convolutions
             return model
-    except Exception as e:
-        raise Exception(f"Error loading model {model_name}: {str(e)}")
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
 
 
-# ==================== IMAGE PREPROCESSING ====================
+def _quantized_cache_path(model_name: str) -> str:
+    return os.path.join(MODEL_CACHE_DIR, f"{model_name}-{checkpoint_version(model_name)}-int8.pt")
 
-def preprocess_image(image: Image.Image, target_size: tuple = (224, 224)) -> torch.Tensor:
-    """Preprocess image for model input"""
-    # Resize image
-    image = image.resize(target_size, Image.BICUBIC)
 
-    # Convert to RGB if needed
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
+def cache_quantized_checkpoint(model_name: str, model: nn.Module):
+    """Store the weights of an int8-dynamic model so later loads skip quantization"""
+    if not any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules()):
+        return
+    try:
+        _write_checkpoint_cache(model_name, _quantized_cache_path(model_name), model.state_dict())
+    except OSError as e:
+        logger.warning("Could not cache quantized weights", extra=log_fields(
+            model=model_name, cache_dir=MODEL_CACHE_DIR, error=str(e)
+        ))
+
+
+def load_quantized_checkpoint(model_name: str):
+    """Load an int8-dynamic model from its cached quantized weights, or None"""
+    cache_path = _quantized_cache_path(model_name)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        state_dict = torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+        model = build_model_on_meta(model_name)
+        _swap_linear_for_quantized(model)
+        model.load_state_dict(state_dict, strict=False, assign=True)
+    except Exception as e:
+        logger.warning("Ignoring unreadable quantized cache", extra=log_fields(path=cache_path, error=str(e)))
+        return None
+    materialize_missing_weights(model)
+    model.eval()
+    return model
+
+
+# Ahead-of-time compiled graphs. export_models.py traces each model to a
+# frozen TorchScript graph, checks it against the eager model and stores it in
+# COMPILED_MODEL_DIR as
+# "<model>-<checkpoint version>-<precision>.ts". load_model uses a matching
+# artifact when one exists and falls back to the eager model otherwise;
+# USE_COMPILED_MODELS=0 always uses eager. optimize_for_inference (oneDNN
+# prepacking, conv/bn folding) runs at load time since its output cannot be
+# serialized.
+COMPILED_MODEL_DIR = os.environ.get('COMPILED_MODEL_DIR') or os.path.join(MODEL_CACHE_DIR, 'compiled')
+USE_COMPILED_MODELS = os.environ.get('USE_COMPILED_MODELS', '1') != '0'
+
+
+class TraceAdapter(nn.Module):
+    """Single traceable forward returning a model's prediction and embedding together"""
+    def __init__(self, model_name: str, model: nn.Module):
+        super().__init__()
+        self.model_name = model_name
+        self.model = model
+
+    def forward(self, *inputs):
+        if self.model_name == 'fusion':
+            return self.model(*inputs)
+        return self.model(*inputs, return_embedding=True)
 
-    # Convert to numpy array and normalize (force float32)
-    img_array = np.array(image).astype(np.float32) / 255.0
 
-    # Normalize to ImageNet stats (also float32)
-    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
-    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
-    img_array = (img_array - mean) / std
+class CompiledModel(nn.Module):
+    """Runs a compiled TorchScript artifact behind the eager model's call signature"""
+    def __init__(self, model_name: str, module, input_dtype=torch.float32, device='cpu'):
+        super().__init__()
+        self.model_name = model_name
+        self.module = module
+        # Frozen graphs have no parameters left; this empty buffer tells
+        # model_input_spec which device and dtype to feed
+        self.register_buffer('input_spec', torch.empty(0, dtype=input_dtype, device=device), persistent=False)
+
+    def forward(self, *inputs, return_embedding=False, return_features=False):
+        output = self.module(*inputs)
+        if self.model_name == 'fusion':
+            return output
+        prediction, embedding = output
+        if return_embedding:
+            return prediction, embedding
+        if return_features:
+            return embedding
+        return prediction
+
 
-    # Convert to tensor **float32** and add batch dimension
-    img_tensor = (
-        torch.from_numpy(img_array)
-        .permute(2, 0, 1)   # HWC ? CHW
-        .unsqueeze(0)      # add batch
-        .float()           # VERY IMPORTANT: make sure it's float32
+def compiled_artifact_path(model_name: str, precision: str) -> str:
+    return os.path.join(
+        COMPILED_MODEL_DIR, f"{model_name}-{checkpoint_version(model_name)}-{precision}.ts"
     )
 
-    return img_tensor
 
-def preprocess_image_512(image: Image.Image) -> torch.Tensor:
-    """Preprocess image for vessel segmentation (512x512)"""
-    # Resize to 512x512
-    image = image.resize((512, 512), Image.BICUBIC)
+def load_compiled_model(model_name: str, precision: str, device, path: Optional[str] = None):
+    """Load the compiled artifact for a model, or None when there is no usable one"""
+    path = path or compiled_artifact_path(model_name, precision)
+    if not os.path.exists(path):
+        return None
+    try:
+        module = torch.jit.load(path, map_location=device)
+    except Exception as e:
+        logger.warning("Ignoring unreadable compiled artifact", extra=log_fields(path=path, error=str(e)))
+        return None
+    module.eval()
+    try:
+        module = torch.jit.optimize_for_inference(module)
+    except Exception as e:
+        logger.warning("Running compiled model without inference optimizations",
+                       extra=log_fields(model=model_name, error=str(e)))
+    input_dtype = torch.bfloat16 if precision == 'bf16' else torch.float32
+    return CompiledModel(model_name, module, input_dtype, device).eval()
 
-    # Ensure RGB
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
 
-    # Convert to float32 in [0, 1]
-    img_array = np.array(image).astype(np.float32) / 255.0
+# Model residency. MODEL_MEMORY_BUDGET_MB caps the weight memory of the models
+# held in `models` (0, the default, keeps every model once it is loaded). A
+# load that would go over the budget first evicts the least recently used
+# models; evicting a base model also evicts fusion, which cannot run without
+# it. Models a batch is running on are pinned (resident_models) and never
+# evicted: when the pinned models alone exceed the budget it is overrun
+# rather than failing the request. Evicted models are reloaded on demand from
+# the memory-mapped checkpoint cache or compiled artifact in MODEL_CACHE_DIR,
+# which is much faster than the first load.
+MODEL_MEMORY_BUDGET_MB = _env_number('MODEL_MEMORY_BUDGET_MB', 0, float)
 
-    # Convert to CHW tensor, add batch dim, ensure float32
-    img_tensor = (
-        torch.from_numpy(img_array)
-        .permute(2, 0, 1)
-        .unsqueeze(0)
-        .float()
-    )
+_model_bytes = {}
 
-    return img_tensor
 
+def estimate_model_bytes(model_name: str, precision: Optional[str] = None) -> int:
+    """Bytes of parameters and buffers a loaded model holds at a precision.
 
-# ==================== PREDICTION FUNCTIONS ====================
+    Computed from the architecture on the meta device rather than from the
+    loaded model, whose compiled (frozen) graph holds its weights as constants.
+    """
+    precision = precision or model_precision(model_name)
+    key = (model_name, precision)
+    if key not in _model_bytes:
+        total = 0
+        for module in build_model_on_meta(model_name).modules():
+            tensors = itertools.chain(module.named_parameters(recurse=False), module.named_buffers(recurse=False))
+            for name, tensor in tensors:
+                if precision == 'int8-dynamic' and type(module) is nn.Linear and name == 'weight':
+                    total += tensor.numel()
+                elif precision == 'bf16' and tensor.is_floating_point():
+                    total += tensor.numel() * 2
+                else:
+                    total += tensor.numel() * tensor.element_size()
+        _model_bytes[key] = total
+    return _model_bytes[key]
+
+
+class ModelResidency:
+    """Keeps the models in `models` within a byte budget, evicting the least recently used"""
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._resident = collections.OrderedDict()  # model name -> bytes, least recently used first
+        self._pins = collections.Counter()
+        self._evicted = set()  # evicted and not loaded since: their next load is a reload
+        self._lock = threading.Lock()
+        self.evictions = collections.Counter()
+        self.reloads = collections.Counter()
+        self.reload_seconds = collections.Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def touch(self, model_name: str):
+        with self._lock:
+            if model_name in self._resident:
+                self._resident.move_to_end(model_name)
+
+    def pin(self, model_names):
+        with self._lock:
+            self._pins.update(list(model_names))
+
+    def unpin(self, model_names):
+        """Release pins; models no longer in use are evicted if the budget is exceeded"""
+        with self._lock:
+            model_names = list(model_names)
+            self._pins.subtract(model_names)
+            if self.enabled and any(self._pins[name] <= 0 for name in model_names):
+                self._evict_over_budget(reason='unpinned')
+
+    def make_room(self, model_name: str):
+        """Reserve a model's bytes before it loads, evicting others to stay within the budget"""
+        needed = estimate_model_bytes(model_name)
+        with self._lock:
+            self._resident[model_name] = needed
+            if not self.enabled:
+                return
+            over = self._evict_over_budget(reason=f'loading {model_name}')
+            if over > 0:
+                logger.warning("Model memory budget exceeded by models in use", extra=log_fields(
+                    model=model_name, over_mb=round(over / 2 ** 20, 1),
+                    budget_mb=round(self.budget_bytes / 2 ** 20, 1),
+                ))
+
+    def _evict_over_budget(self, reason: str) -> int:
+        """Evict least recently used models until within the budget; returns the bytes still over"""
+        over = sum(self._resident.values()) - self.budget_bytes
+        victims = []
+        for name in list(self._resident):
+            if over <= 0:
+                break
+            group = [name] + [
+                dependent for dependent, dependencies in MODEL_DEPENDENCIES.items()
+                if name in dependencies and dependent in self._resident and dependent not in victims
+            ]
+            if name in victims or not all(self._evictable(member) for member in group):
+                continue
+            victims.extend(member for member in group if member not in victims)
+            over -= sum(self._resident[member] for member in group)
+        with _loading_lock:
+            for name in victims:
+                models.pop(name, None)
+        for name in victims:
+            self.evictions[name] += 1
+            self._evicted.add(name)
+            logger.info("Evicted model", extra=log_fields(
+                model=name, mb=round(self._resident.pop(name) / 2 ** 20, 1), reason=reason
+            ))
+        return over
+
+    def _evictable(self, model_name: str) -> bool:
+        # Models still loading are not in `models` yet and cannot be evicted
+        return self._pins[model_name] <= 0 and model_name in models
+
+    def loaded(self, model_name: str, seconds: float):
+        with self._lock:
+            if model_name in self._resident:
+                self._resident.move_to_end(model_name)
+            if model_name in self._evicted:
+                self._evicted.discard(model_name)
+                self.reloads[model_name] += 1
+                self.reload_seconds[model_name] += seconds
+                MODEL_RELOAD_SECONDS.observe(seconds, model=model_name)
+
+    def release(self, model_name: str):
+        """Drop the reservation of a load that failed"""
+        with self._lock:
+            if model_name not in models:
+                self._resident.pop(model_name, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'budget_bytes': self.budget_bytes,
+                'resident_bytes': sum(self._resident.values()),
+                'resident': list(self._resident),
+                'evictions': sum(self.evictions.values()),
+                'reloads': sum(self.reloads.values()),
+                'models': {
+                    name: {
+                        'bytes': self._resident.get(name, 0),
+                        'pinned': max(0, self._pins[name]),
+                        'evictions': self.evictions[name],
+                        'reloads': self.reloads[name],
+                        'mean_reload_seconds': round(self.reload_seconds[name] / self.reloads[name], 3)
+                        if self.reloads[name] else None,
+                    }
+                    for name in MODEL_PATHS
+                },
+            }
 
-def predict_hypertension(model, image_tensor):
-    """Predict hypertension (binary classification)"""
-    device = next(model.parameters()).device
-    image_tensor = image_tensor.to(device)
+
+residency = ModelResidency(int(MODEL_MEMORY_BUDGET_MB * 2 ** 20))
+
+
+@contextlib.contextmanager
+def pinned_models(model_names):
+    """Keep models, loaded or not yet, from being evicted until the block exits"""
+    model_names = list(model_names)
+    residency.pin(model_names)
+    try:
+        yield
+    finally:
+        residency.unpin(model_names)
+
+
+@contextlib.contextmanager
+def resident_models(*model_names):
+    """Load models and keep them from being evicted until the block exits; yields them in order"""
+    with pinned_models(model_names):
+        yield [load_model(name) for name in model_names]
+
+
+# Loads in progress: model name -> Future shared by every caller waiting on it
+_loading = {}
+_loading_lock = threading.Lock()
+
+
+def load_model(model_name: str):
+    """Load a PyTorch model.
+
+    Single-flight per model name: when several threads ask for a model that
+    is not loaded yet, one of them loads it and the others wait for (and
+    share) its result or error.
+    """
+    model = models.get(model_name)
+    if model is not None:
+        residency.touch(model_name)
+        return model
+
+    with _loading_lock:
+        if model_name in models:
+            return models[model_name]
+        future = _loading.get(model_name)
+        is_loader = future is None
+        if is_loader:
+            future = Future()
+            _loading[model_name] = future
+
+    if not is_loader:
+        return future.result()
+
+    try:
+        residency.make_room(model_name)
+        start = time.perf_counter()
+        model = load_model_uncached(model_name)
+    except BaseException as e:
+        residency.release(model_name)
+        MODEL_LOADS.inc(model=model_name, outcome='failure')
+        logger.error("Model load failed", extra=log_fields(model=model_name, error=str(e)))
+        with _loading_lock:
+            del _loading[model_name]
+        future.set_exception(e)
+        raise
+
+    seconds = time.perf_counter() - start
+    MODEL_LOADS.inc(model=model_name, outcome='success')
+    MODEL_LOAD_SECONDS.observe(seconds, model=model_name)
+    logger.info("Loaded model", extra=log_fields(
+        model=model_name, seconds=round(seconds, 3), precision=model_precision(model_name),
+        compiled=isinstance(model, CompiledModel),
+    ))
+    with _loading_lock:
+        models[model_name] = model
+        del _loading[model_name]
+    residency.loaded(model_name, seconds)
+    future.set_result(model)
+    return model
+
+
+async def load_model_async(model_name: str):
+    """load_model for coroutines: loads on a worker thread, sharing in-flight loads"""
+    model = models.get(model_name)
+    if model is not None:
+        residency.touch(model_name)
+        return model
+    return await asyncio.get_running_loop().run_in_executor(None, load_model, model_name)
+
+
+def _load_fp32_model(model_name: str, model_path: str):
+    """Build a model and load its checkpoint in full precision on the CPU"""
+    # Load checkpoint (memory-mapped from the local cache when possible)
+    loaded_data = load_checkpoint(model_name, model_path)
+    state_dict = extract_state_dict(loaded_data)
     
-    with torch.no_grad():
-        output = model(image_tensor)
-        
-        # Handle different output formats
-        if isinstance(output, (list, tuple)):
-            output = output[0]
-        
-        # Get prediction (0 or 1)
-        # Output is logits, apply sigmoid
-        prob = torch.sigmoid(output).item()
-        prediction = 1 if prob > 0.5 else 0
-        confidence = prob if prediction == 1 else 1 - prob
-        
-        return int(prediction), float(confidence)
+    # Check if it's a state dict or full model
+    if state_dict is None:
+        # It's a full model object
+        model = loaded_data
+        model.eval()
+        return model
+    
+    # Create model instance based on model_name, on the meta device:
+    # its weights are never allocated or randomly initialised
+    model = build_model_on_meta(model_name)
+    
+    # Load state dict. assign=True makes the modules adopt the
+    # checkpoint tensors instead of copying them into fresh ones.
+    try:
+        model.load_state_dict(state_dict, strict=False, assign=True)
+    except Exception as e:
+        logger.warning("Could not load all weights strictly", extra=log_fields(model=model_name, error=str(e)))
+        # Try non-strict loading
+        model.load_state_dict(state_dict, strict=False, assign=True)
+    
+    missing = materialize_missing_weights(model)
+    if missing:
+        logger.warning("Checkpoint is missing weights, using default initialisation", extra=log_fields(
+            model=model_name, missing=len(missing), tensors=', '.join(missing[:10])
+        ))
+    
+    model.eval()
+    return model
 
 
-def predict_cimt(model, left_img_tensor, right_img_tensor):
-    """Predict CIMT (regression) - requires left and right eye images"""
-    device = next(model.parameters()).device
-    left_img = left_img_tensor.to(device)
-    right_img = right_img_tensor.to(device)
+def load_model_uncached(model_name: str, precision: Optional[str] = None, use_compiled: bool = True):
+    """Build a model and load its checkpoint (no caching, see load_model).
+
+    precision is one of PRECISIONS and defaults to model_precision(model_name).
+    With use_compiled, a matching compiled artifact is preferred over eager.
+    """
+    precision = normalize_precision(precision) if precision else model_precision(model_name)
     
-    # Create dummy clinical features (age normalized, gender)
-    # Using default values: age_norm=0.5 (middle age), gender=[0.5, 0.5] (neutral)
-    clinical = torch.tensor([[0.5, 0.5, 0.5]], dtype=torch.float32).to(device)
+    if SYNTHETIC_MODELS:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if device.type != 'cpu' and precision == 'int8-dynamic':
+            precision = 'fp32'
+        return apply_precision(build_synthetic_model(model_name), precision).to(device)
     
-    with torch.no_grad():
-        output = model(left_img, right_img, clinical)
-        
-        # Handle different output formats
-        if isinstance(output, (list, tuple)):
-            output = output[0]
+    # Ensure the model file exists locally (download if needed in cloud)
+    model_path = ensure_model_file(model_name)
+    
+    try:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
-        # Get regression value
-        value = output.item() if output.numel() == 1 else output[0].item()
+        if use_compiled and USE_COMPILED_MODELS:
+            model = load_compiled_model(model_name, precision, device)
+            if model is not None:
+                return model
         
-        # Clamp to expected range (0.4 to 1.2)
-        value = max(0.4, min(1.2, value))
+        if precision == 'int8-dynamic':
+            if device.type != 'cpu':
+                logger.warning("int8-dynamic is CPU-only, running in fp32",
+                               extra=log_fields(model=model_name, device=str(device)))
+                precision = 'fp32'
+            else:
+                model = load_quantized_checkpoint(model_name)
+                if model is not None:
+                    return model
         
-        return float(value)
+        model = _load_fp32_model(model_name, model_path)
+        model = apply_precision(model, precision)
+        if precision == 'int8-dynamic':
+            cache_quantized_checkpoint(model_name, model)
+        model.to(device)
+        return model
+    except Exception as e:
+        raise Exception(f"Error loading model {model_name}: {str(e)}")
 
 
-def predict_vessel(model, image_tensor, original_image):
-    """Predict vessel segmentation and handcrafted features.
+# ==================== IMAGE PREPROCESSING ====================
+# An upload is decoded and converted to RGB once; every model input variant
+# is then resized from it and written as CHW float32 straight into its output
+# buffer. Input variants are keyed by size: 224 inputs are ImageNet-normalized,
+# 512 inputs are scaled to [0, 1] (as the models were trained). Both
+# normalizations are folded into one multiply-add per channel,
+# out = pixel * scale + offset, so no full-size float temporaries are created.
+
+# Set JPEG_DRAFT_DECODE=0 to always decode uploads at full resolution
+JPEG_DRAFT_DECODE = os.environ.get('JPEG_DRAFT_DECODE', '1') != '0'
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def _channel_affine(normalize: bool):
+    """Per-channel (scale, offset) turning uint8 pixels into model input values"""
+    if not normalize:
+        return [(np.float32(1.0 / 255.0), np.float32(0.0))] * 3
+    return [
+        (np.float32(1.0 / (255.0 * std)), np.float32(-mean / std))
+        for mean, std in zip(IMAGENET_MEAN, IMAGENET_STD)
+    ]
+
+
+INPUT_VARIANTS = {
+    224: _channel_affine(normalize=True),
+    512: _channel_affine(normalize=False),
+}
+
+
+def decode_image(image_bytes: bytes, target_size: Optional[int] = None):
+    """Decode an upload to an RGB image.
+
+    With target_size, JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or
+    1/8) that still covers target_size x target_size, which is much faster and
+    smaller than decoding a 3000-4000 px photograph in full.
 
     Returns:
-        masked_image_b64: PNG of binary vessel mask (0/255) resized to original image size.
-        features: dict of simple handcrafted statistics derived from the soft vessel mask.
+        (image, original_size) where original_size is the size of the upload
     """
-    device = next(model.parameters()).device
-    image_tensor = image_tensor.to(device)
+    image = Image.open(io.BytesIO(image_bytes))
+    original_size = image.size
+    if target_size and JPEG_DRAFT_DECODE:
+        # No-op for formats other than JPEG
+        image.draft('RGB', (target_size, target_size))
+    # Decode now rather than lazily on first use, so decode time is its own stage
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image, original_size
 
-    with torch.no_grad():
-        output = model(image_tensor)
 
-        # Handle different output formats
-        if isinstance(output, (list, tuple)):
-            output = output[0]
+def preprocess_into(image: Image.Image, out, size: int):
+    """Resize an RGB image and write it normalized into out, a (3, size, size) float32 array or tensor"""
+    if isinstance(out, torch.Tensor):
+        out = out.numpy()
+    pixels = np.asarray(image.resize((size, size), Image.BICUBIC))
+    for channel, (scale, offset) in enumerate(INPUT_VARIANTS[size]):
+        np.multiply(pixels[:, :, channel], scale, out=out[channel])
+        out[channel] += offset
+    return out
 
-        # Soft mask probabilities in [0, 1]
-        prob_mask = torch.sigmoid(output).cpu().numpy()[0, 0]
 
-        # Get binary segmentation mask (single channel, 0 or 255) for visualization
-        mask = (prob_mask > 0.5).astype(np.uint8) * 255
+def preprocess_variants(image: Image.Image, sizes=(224,)) -> dict:
+    """Preprocess an image for several input sizes; returns {size: (1, 3, size, size) tensor}"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    tensors = {}
+    for size in sizes:
+        out = np.empty((1, 3, size, size), dtype=np.float32)
+        preprocess_into(image, out[0], size)
+        tensors[size] = torch.from_numpy(out)
+    return tensors
 
-        # Resize mask to original image size
-        mask_pil = Image.fromarray(mask, mode='L')
-        mask_pil = mask_pil.resize(original_image.size, Image.NEAREST)
 
-        # Return the mask itself (white vessels on black background) as PNG
-        buffer = io.BytesIO()
-        mask_pil.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
+def preprocess_image(image: Image.Image, target_size: tuple = (224, 224)) -> torch.Tensor:
+    """Preprocess image for model input"""
+    return preprocess_variants(image, (target_size[0],))[target_size[0]]
 
-        # Handcrafted features similar to those used in fusion (15 values total)
-        flat = prob_mask.flatten()
-        vessel_density = float(flat.mean())
-        vessel_std = float(flat.std())
-        percentiles = np.percentile(flat, np.linspace(0, 100, 13)).astype(np.float32)
 
-        feature_names = [
-            "vessel_density",
-            "vessel_std",
-        ] + [f"percentile_{int(p)}" for p in np.linspace(0, 100, 13)]
+def preprocess_image_512(image: Image.Image) -> torch.Tensor:
+    """Preprocess image for vessel segmentation (512x512)"""
+    return preprocess_variants(image, (512,))[512]
 
-        feature_values = [vessel_density, vessel_std] + [float(p) for p in percentiles.tolist()]
-        features = dict(zip(feature_names, feature_values))
 
-        return img_str, features
+# ==================== PREDICTION FUNCTIONS ====================
+# Every predict_*_batch function takes tensors with a leading batch dimension
+# and returns one result per row; the single-image predict_* functions are
+# thin wrappers kept for existing callers.
 
-def predict_fusion(left_img_tensor, right_img_tensor, htn_model, cimt_model, vessel_model, fusion_model):
+def model_input_spec(model):
+    """Device and floating-point dtype a model expects its inputs in"""
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        if tensor.is_floating_point():
+            return tensor.device, tensor.dtype
+    # e.g. a fully int8-quantized MLP keeps its weights in packed params
+    return torch.device('cpu'), torch.float32
+
+
+def to_model_input(tensor: torch.Tensor, model) -> torch.Tensor:
+    """Move an input tensor to a model's device and precision"""
+    device, dtype = model_input_spec(model)
+    return tensor.to(device=device, dtype=dtype)
+
+
+def dummy_clinical_features(batch_size: int, device='cpu') -> torch.Tensor:
+    """Dummy clinical features (age normalized, gender) for a batch"""
+    # Using default values: age_norm=0.5 (middle age), gender=[0.5, 0.5] (neutral)
+    return torch.full((batch_size, 3), 0.5, dtype=torch.float32, device=device)
+
+
+def hypertension_features(logits, embedding) -> np.ndarray:
+    """Fusion input block of the HTN model: 1 prob + 1024 embedding per row"""
+    prob = torch.sigmoid(logits.float()).cpu().numpy()[:, :1]
+    return np.concatenate([prob, embedding.float().cpu().numpy()], axis=1)
+
+
+def cimt_features(pred, embedding) -> np.ndarray:
+    """Fusion input block of the CIMT model: 1 raw pred + 128 embedding per row"""
+    return np.concatenate([pred.float().cpu().numpy()[:, :1], embedding.float().cpu().numpy()], axis=1)
+
+
+# Vessel mask percentiles come from a fixed histogram over [0, 1] instead of
+# a sort: one counting pass per mask, accurate to half a bin (~8e-6).
+# Counts, sums and sums of squares add up, so masks processed in pieces can
+# be accumulated before vessel_statistics is taken.
+VESSEL_HISTOGRAM_BINS = 1 << 16
+VESSEL_PERCENTILES = np.linspace(0, 100, 13)
+
+
+def vessel_mask_moments(prob_masks):
+    """Additive per-mask accumulators: (histogram counts, sums, sums of squares)"""
+    flat = np.asarray(prob_masks, dtype=np.float32).reshape(len(prob_masks), -1)
+    batch_size, bins = flat.shape[0], VESSEL_HISTOGRAM_BINS
+    sums = flat.sum(axis=1, dtype=np.float64)
+    sums_sq = np.einsum('ij,ij->i', flat, flat, dtype=np.float64)
+    # Nearest bin, offset per mask so a single bincount covers the batch
+    scaled = flat * np.float32(bins - 1)
+    scaled += np.float32(0.5)
+    np.clip(scaled, 0, bins - 1, out=scaled)
+    bin_index = scaled.astype(np.int32)
+    bin_index += (np.arange(batch_size, dtype=np.int32) * bins)[:, None]
+    counts = np.bincount(bin_index.ravel(), minlength=batch_size * bins).reshape(batch_size, bins)
+    return counts, sums, sums_sq
+
+
+def vessel_statistics(counts, sums, sums_sq) -> np.ndarray:
+    """Density, std and 13 percentiles (np.percentile's linear method) per mask from its moments"""
+    stats = np.zeros((len(counts), 15), dtype=np.float32)
+    for i, (mask_counts, total, total_sq) in enumerate(zip(counts, sums, sums_sq)):
+        n = int(mask_counts.sum())
+        mean = total / n
+        stats[i, 0] = mean  # vessel_density
+        stats[i, 1] = np.sqrt(max(total_sq / n - mean * mean, 0.0))  # texture_variance (simplified)
+        # Value of order statistic k = centre of the bin holding it
+        position = VESSEL_PERCENTILES / 100.0 * (n - 1)
+        lower = np.floor(position)
+        cumulative = np.cumsum(mask_counts)
+        low = np.searchsorted(cumulative, lower, side='right')
+        high = np.searchsorted(cumulative, np.minimum(lower + 1, n - 1), side='right')
+        stats[i, 2:15] = (low + (high - low) * (position - lower)) / (VESSEL_HISTOGRAM_BINS - 1)
+    return stats
+
+
+def vessel_mask_statistics(prob_masks) -> np.ndarray:
+    """Simplified handcrafted vessel features (15 per mask): density, std and 13 percentiles"""
+    return vessel_statistics(*vessel_mask_moments(prob_masks))
+
+
+def vessel_features(prob_masks, learned) -> np.ndarray:
+    """Fusion input block of the vessel model: 256 learned + 15 handcrafted per row"""
+    return np.concatenate([learned.float().cpu().numpy(), vessel_mask_statistics(prob_masks)], axis=1)
+
+
+def predict_hypertension_batch(model, image_tensor):
+    """Predict hypertension (binary classification) for a batch of images"""
+    digests = tensor_digests(image_tensor)
+    image_tensor = to_model_input(image_tensor, model)
+
+    with torch.no_grad():
+        output, embedding = model(image_tensor, return_embedding=True)
+
+        # Output is logits, apply sigmoid
+        probs = torch.sigmoid(output.float()).reshape(output.shape[0], -1)[:, 0].tolist()
+        store_embeddings('hypertension', digests, hypertension_features(output, embedding))
+
+    results = []
+    for prob in probs:
+        # Get prediction (0 or 1)
+        prediction = 1 if prob > 0.5 else 0
+        confidence = prob if prediction == 1 else 1 - prob
+        results.append((int(prediction), float(confidence)))
+    return results
+
+
+def predict_hypertension(model, image_tensor):
+    """Predict hypertension (binary classification)"""
+    return predict_hypertension_batch(model, image_tensor)[0]
+
+
+def predict_cimt_batch(model, left_img_tensor, right_img_tensor):
+    """Predict CIMT (regression) for a batch of left/right eye pairs"""
+    left_img = to_model_input(left_img_tensor, model)
+    right_img = to_model_input(right_img_tensor, model)
+    clinical = to_model_input(dummy_clinical_features(left_img.shape[0]), model)
+
+    with torch.no_grad():
+        output, embedding = model(left_img, right_img, clinical, return_embedding=True)
+
+        # Get regression value
+        values = output.float().reshape(output.shape[0], -1)[:, 0].tolist()
+
+    # Clamp to expected range (0.4 to 1.2)
+    return [float(max(0.4, min(1.2, value))) for value in values]
+
+
+def predict_cimt(model, left_img_tensor, right_img_tensor):
+    """Predict CIMT (regression) - requires left and right eye images"""
+    return predict_cimt_batch(model, left_img_tensor, right_img_tensor)[0]
+
+
+def predict_vessel_batch(model, image_tensor):
+    """Run vessel segmentation on a batch and return the soft masks.
+
+    Returns:
+        list of float32 arrays (H x W) with vessel probabilities in [0, 1].
+    """
+    image_tensor = to_model_input(image_tensor, model)
+
+    with torch.no_grad():
+        output = model(image_tensor)
+
+        # Soft mask probabilities in [0, 1]
+        prob_masks = torch.sigmoid(output.float()).cpu().numpy()[:, 0]
+
+    return list(prob_masks)
+
+
+# Names of the 15 handcrafted vessel features, in vessel_mask_statistics order
+VESSEL_FEATURE_NAMES = [
+    "vessel_density",
+    "vessel_std",
+] + [f"percentile_{int(p)}" for p in VESSEL_PERCENTILES]
+
+
+def vessel_outputs(prob_mask, original_size):
+    """Turn a soft vessel mask into the API outputs of predict_vessel"""
+    # Binary segmentation mask (single channel, 0 or 255) at the original
+    # image size, returned itself (white vessels on black background) as PNG
+    mask_pil = vessel_mask_image(prob_mask, original_size)
+    img_str = base64.b64encode(encode_vessel_mask(mask_pil, 'png')).decode()
+
+    # Handcrafted features, the same ones used in fusion (15 values total)
+    feature_values = vessel_mask_statistics([prob_mask])[0].tolist()
+    features = dict(zip(VESSEL_FEATURE_NAMES, feature_values))
+
+    return img_str, features
+
+
+# Vessel results can also be returned as binary bodies instead of JSON with a
+# base64 PNG (see /predict's format and mask_resolution fields):
+# - png: the binary mask as image/png
+# - packbits: the mask as application/octet-stream, rows packed MSB-first and
+#   padded to whole bytes (np.packbits(mask, axis=1)); X-Mask-Shape holds
+#   "height,width"
+# - multipart: multipart/mixed with a JSON part (features and mask shape) and
+#   an image/png part
+# For png and packbits the features travel as JSON in X-Vessel-Features.
+# mask_resolution=model skips resizing the mask to the upload's size.
+VESSEL_FORMATS = ('json', 'png', 'packbits', 'multipart')
+VESSEL_MASK_RESOLUTIONS = ('original', 'model')
+
+
+def vessel_mask_image(prob_mask, size=None) -> Image.Image:
+    """Binary vessel mask (0/255, mode L), resized with NEAREST when size is given"""
+    mask = Image.fromarray((prob_mask > 0.5).astype(np.uint8) * 255, mode='L')
+    if size is not None and tuple(size) != mask.size:
+        mask = mask.resize(tuple(size), Image.NEAREST)
+    return mask
+
+
+def encode_vessel_mask(mask: Image.Image, encoding: str) -> bytes:
+    if encoding == 'packbits':
+        return np.packbits(np.asarray(mask) > 127, axis=1).tobytes()
+    buffer = io.BytesIO()
+    mask.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def vessel_response_parts(prob_mask, original_size, fmt: str, mask_resolution: str = 'original'):
+    """Encode a vessel result for one of VESSEL_FORMATS (see encode_vessel_result)"""
+    size = original_size if mask_resolution == 'original' else None
+    with timed_stage('mask_features'):
+        features = dict(zip(VESSEL_FEATURE_NAMES, vessel_mask_statistics([prob_mask])[0].tolist()))
+    with timed_stage('encode'):
+        return encode_vessel_result(vessel_mask_image(prob_mask, size), features, fmt)
+
+
+def encode_vessel_result(mask: Image.Image, features: dict, fmt: str):
+    """Encode a binary mask and its features for one of VESSEL_FORMATS.
+
+    Returns the /predict JSON dict for 'json', otherwise
+    (media_type, body, headers) for a raw Response.
+    """
+    if fmt == 'json':
+        masked_image = base64.b64encode(encode_vessel_mask(mask, 'png')).decode()
+        return {'masked_image': masked_image, 'features': features}
+
+    width, height = mask.size
+    if fmt == 'multipart':
+        boundary = os.urandom(12).hex()
+        summary = json.dumps({'features': features, 'mask': {'width': width, 'height': height}})
+        body = b''.join([
+            f'--{boundary}\r\nContent-Type: application/json\r\n\r\n{summary}\r\n'.encode(),
+            f'--{boundary}\r\nContent-Type: image/png\r\n'
+            f'Content-Disposition: attachment; filename="vessel_mask.png"\r\n\r\n'.encode(),
+            encode_vessel_mask(mask, 'png'),
+            f'\r\n--{boundary}--\r\n'.encode(),
+        ])
+        return f'multipart/mixed; boundary={boundary}', body, {}
+
+    headers = {'X-Vessel-Features': json.dumps(features), 'X-Mask-Shape': f'{height},{width}'}
+    if fmt == 'packbits':
+        return 'application/octet-stream', encode_vessel_mask(mask, 'packbits'), headers
+    return 'image/png', encode_vessel_mask(mask, 'png'), headers
+
+
+def predict_vessel(model, image_tensor, original_image):
+    """Predict vessel segmentation and handcrafted features.
+
+    original_image is the uploaded PIL image or just its (width, height);
+    only the size is used.
+
+    Returns:
+        masked_image_b64: PNG of binary vessel mask (0/255) resized to original image size.
+        features: dict of simple handcrafted statistics derived from the soft vessel mask.
+    """
+    prob_mask = predict_vessel_batch(model, image_tensor)[0]
+    original_size = original_image.size if isinstance(original_image, Image.Image) else tuple(original_image)
+    return vessel_outputs(prob_mask, original_size)
+
+
+def predict_fusion_batch(left_img_tensor, right_img_tensor, htn_model, cimt_model, vessel_model, fusion_model):
     """
     Predict using fusion model by extracting features from all three base models.
+    Works on a batch of left/right pairs and returns one result dict per pair.
     
     Features extracted:
     - HTN: 1 prob + 1024 embedding = 1025
@@ -517,89 +1726,1056 @@ def predict_fusion(left_img_tensor, right_img_tensor, htn_model, cimt_model, ves
     - Vessel: 256 learned + 15 handcrafted (simplified) = 271
     Total: 1425 features
     """
-    device = next(fusion_model.parameters()).device
+    batch_size = left_img_tensor.shape[0]
     
-    # Preprocess for different models
-    # HTN uses left eye image (224x224)
-    htn_tensor = left_img_tensor.to(device)
+    # Model inputs, in float32 on the CPU so they can be looked up in the
+    # embedding cache; each model still runs on its own device and precision.
+    # HTN uses the left eye image (224x224)
+    htn_input = left_img_tensor
     
     # CIMT uses both left and right eye images (224x224)
     left_cimt = torch.nn.functional.interpolate(
         left_img_tensor, size=(224, 224), mode='bilinear', align_corners=False
-    ).to(device)
+    )
     right_cimt = torch.nn.functional.interpolate(
         right_img_tensor, size=(224, 224), mode='bilinear', align_corners=False
-    ).to(device)
+    )
     
     # Vessel uses left eye image (512x512)
-    vessel_tensor = torch.nn.functional.interpolate(
+    vessel_input = torch.nn.functional.interpolate(
         left_img_tensor, size=(512, 512), mode='bilinear', align_corners=False
-    ).to(device)
+    )
+    
+    def run_htn(rows):
+        logits, embedding = htn_model(to_model_input(htn_input[rows], htn_model), return_embedding=True)
+        return hypertension_features(logits, embedding)
+    
+    def run_cimt(rows):
+        clinical = to_model_input(dummy_clinical_features(len(rows)), cimt_model)
+        pred, embedding = cimt_model(
+            to_model_input(left_cimt[rows], cimt_model),
+            to_model_input(right_cimt[rows], cimt_model),
+            clinical, return_embedding=True,
+        )
+        return cimt_features(pred, embedding)
+    
+    def run_vessel(rows):
+        # One UNet pass gives both the mask and the encoder features
+        mask, learned = vessel_model(to_model_input(vessel_input[rows], vessel_model), return_embedding=True)
+        return vessel_features(torch.sigmoid(mask.float()).cpu().numpy()[:, 0], learned)
     
     with torch.no_grad():
-        # 1. Extract HTN features (1025 dim: 1 prob + 1024 embedding)
-        htn_logits, htn_embedding = htn_model(htn_tensor, return_embedding=True)
-        htn_prob = torch.sigmoid(htn_logits).cpu().numpy()[0, 0]
-        htn_emb = htn_embedding.cpu().numpy()[0]
-        htn_features = np.concatenate([[htn_prob], htn_emb])  # 1025 dim
-        
-        # 2. Extract CIMT features (129 dim: 1 pred + 128 embedding)
-        # Use both left and right eye images with dummy clinical features
-        clinical = torch.tensor([[0.5, 0.5, 0.5]], dtype=torch.float32).to(device)
-        
-        cimt_pred, cimt_embedding = cimt_model(left_cimt, right_cimt, clinical, return_embedding=True)
-        cimt_pred_val = cimt_pred.cpu().numpy()[0, 0]
-        cimt_emb = cimt_embedding.cpu().numpy()[0]
-        cimt_features = np.concatenate([[cimt_pred_val], cimt_emb])  # 129 dim
-        
-        # 3. Extract Vessel features (271 dim: 256 learned + 15 handcrafted)
-        vessel_learned = vessel_model(vessel_tensor, return_features=True).cpu().numpy()[0]  # 256 dim
+        # Base-model features are taken from the embedding cache when the same
+        # inputs were scored before; only the missing rows are run.
+        # 1. HTN features (1025 dim: 1 prob + 1024 embedding)
+        with timed_stage('hypertension_features', 'fusion'):
+            htn_block = cached_embeddings('hypertension', tensor_digests(htn_input), batch_size, run_htn)
         
-        # Simplified handcrafted features (15 dim) - using zeros for now
-        # In production, you'd extract these from the vessel mask
-        vessel_handcrafted = np.zeros(15, dtype=np.float32)
+        # 2. CIMT features (129 dim: 1 pred + 128 embedding), both eyes with
+        # dummy clinical features
+        with timed_stage('cimt_features', 'fusion'):
+            cimt_block = cached_embeddings('cimt', pair_digests(left_cimt, right_cimt), batch_size, run_cimt)
         
-        # Get vessel mask for basic feature extraction
-        vessel_mask = vessel_model(vessel_tensor, return_features=False)
-        vessel_mask_np = torch.sigmoid(vessel_mask).cpu().numpy()[0, 0]
-        
-        # Extract basic handcrafted features (simplified version)
-        vessel_handcrafted[0] = vessel_mask_np.mean()  # vessel_density
-        vessel_handcrafted[1] = vessel_mask_np.std()  # texture_variance (simplified)
-        # Fill rest with basic stats
-        vessel_handcrafted[2:15] = np.percentile(vessel_mask_np.flatten(), 
-                                                 np.linspace(0, 100, 13))
-        
-        vessel_features = np.concatenate([vessel_learned, vessel_handcrafted])  # 271 dim
+        # 3. Vessel features (271 dim: 256 learned + 15 handcrafted)
+        with timed_stage('vessel_features', 'fusion'):
+            vessel_block = cached_embeddings('vessel', tensor_digests(vessel_input), batch_size, run_vessel)
         
         # 4. Combine all features (1425 dim total)
         fusion_features = np.concatenate([
-            htn_features,    # 1025
-            cimt_features,    # 129
-            vessel_features   # 271
-        ]).astype(np.float32)
+            htn_block,       # 1025
+            cimt_block,      # 129
+            vessel_block     # 271
+        ], axis=1).astype(np.float32)
         
-        # 5. Normalize features (using simple normalization)
+        # 5. Normalize features per sample (using simple normalization)
         # In production, you'd use the same normalization as training
-        fusion_features = (fusion_features - fusion_features.mean()) / (fusion_features.std() + 1e-8)
+        fusion_features = (
+            (fusion_features - fusion_features.mean(axis=1, keepdims=True))
+            / (fusion_features.std(axis=1, keepdims=True) + 1e-8)
+        )
         
         # 6. Run fusion model
-        fusion_tensor = torch.from_numpy(fusion_features).unsqueeze(0).to(device)
-        fusion_output = fusion_model(fusion_tensor)
-        fusion_prob = torch.sigmoid(fusion_output).item()
+        with timed_stage('fusion_head', 'fusion'):
+            fusion_tensor = to_model_input(torch.from_numpy(fusion_features), fusion_model)
+            fusion_output = fusion_model(fusion_tensor)
+            fusion_probs = torch.sigmoid(fusion_output.float()).reshape(batch_size, -1)[:, 0].tolist()
+    
+    results = []
+    for i, fusion_prob in enumerate(fusion_probs):
         fusion_pred = 1 if fusion_prob > 0.5 else 0
-        
-        return {
+        results.append({
             'prediction': fusion_pred,
             'probability': float(fusion_prob),
             'components': {
-                'hypertension': int(htn_pred) if (htn_pred := 1 if htn_prob > 0.5 else 0) else 0,
-                'cimt': float(cimt_pred_val),
-                'vessel_density': float(vessel_handcrafted[0])
+                'hypertension': 1 if htn_block[i, 0] > 0.5 else 0,
+                'cimt': float(cimt_block[i, 0]),
+                'vessel_density': float(vessel_block[i, 256])
             }
+        })
+    return results
+
+
+def predict_fusion(left_img_tensor, right_img_tensor, htn_model, cimt_model, vessel_model, fusion_model):
+    """Predict using fusion model for a single left/right pair"""
+    return predict_fusion_batch(
+        left_img_tensor, right_img_tensor, htn_model, cimt_model, vessel_model, fusion_model
+    )[0]
+
+
+# ==================== TILED VESSEL SEGMENTATION ====================
+# segmentation=tiled on /predict runs the fully convolutional UNet over the
+# upload at its native resolution instead of a 512x512 downscale, so fine
+# capillaries survive. Tiles of VESSEL_TILE_SIZE overlap by
+# VESSEL_TILE_OVERLAP and their probabilities are blended with linear ramps.
+# One row of tiles (a band) is processed at a time, in batches sized so the
+# UNet's activations stay under VESSEL_TILE_MEMORY_MB; finished rows are
+# thresholded into the output mask and folded into the feature histogram
+# right away, so the float buffers hold at most one band whatever the height.
+
+VESSEL_TILE_SIZE = _env_number('VESSEL_TILE_SIZE', 512)
+VESSEL_TILE_OVERLAP = _env_number('VESSEL_TILE_OVERLAP', 64)
+VESSEL_TILE_MEMORY_MB = _env_number('VESSEL_TILE_MEMORY_MB', 1024, float)
+
+# Peak activation memory of a UNet forward pass per input pixel (fp32, CPU,
+# measured at 512x512: ~720 MB per tile)
+UNET_BYTES_PER_PIXEL = 2900
+
+
+def tile_starts(length: int, tile: int, stride: int) -> list:
+    """Tile offsets covering [0, length), the last one flush with the end"""
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def tile_weights(tile: int, overlap: int) -> np.ndarray:
+    """Blending weights: 1 in the tile centre, ramping down across the overlap"""
+    ramp = np.minimum(1.0, (np.arange(tile, dtype=np.float32) + 1) / (overlap + 1))
+    ramp = np.minimum(ramp, ramp[::-1])
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def tiles_per_batch(tile: int, memory_mb: float) -> int:
+    return max(1, int(memory_mb * 2 ** 20 // (tile * tile * UNET_BYTES_PER_PIXEL)))
+
+
+def segment_vessels_tiled(model, image: Image.Image, tile_size: Optional[int] = None,
+                          overlap: Optional[int] = None, memory_mb: Optional[float] = None):
+    """Segment vessels on an RGB image at native resolution.
+
+    Returns:
+        (mask, features): a uint8 (height, width) array of 0/255 and the 15
+        handcrafted features of the full-resolution soft mask.
+    """
+    tile = tile_size or VESSEL_TILE_SIZE
+    overlap = VESSEL_TILE_OVERLAP if overlap is None else overlap
+    if tile % 4 or not 0 <= overlap < tile:
+        raise ValueError(f"Invalid tiling: tile {tile} (multiple of 4 required), overlap {overlap}")
+    per_batch = tiles_per_batch(tile, memory_mb or VESSEL_TILE_MEMORY_MB)
+    device, dtype = model_input_spec(model)
+
+    width, height = image.size
+    pixels = np.asarray(image.convert('RGB'))
+    # Images smaller than a tile are padded at the bottom/right edge
+    if height < tile or width < tile:
+        pad = ((0, max(0, tile - height)), (0, max(0, tile - width)), (0, 0))
+        pixels = np.pad(pixels, pad, mode='edge')
+    padded_width = pixels.shape[1]
+    ys = tile_starts(pixels.shape[0], tile, tile - overlap)
+    xs = tile_starts(padded_width, tile, tile - overlap)
+    weights = tile_weights(tile, overlap)
+
+    # Blending accumulators for the current band (rows y .. y + tile)
+    blended = np.zeros((tile, padded_width), dtype=np.float32)
+    weight_sum = np.zeros((tile, padded_width), dtype=np.float32)
+    mask = np.empty((height, width), dtype=np.uint8)
+    counts = np.zeros(VESSEL_HISTOGRAM_BINS, dtype=np.int64)
+    total = total_sq = 0.0
+
+    for row, y in enumerate(ys):
+        band = pixels[y:y + tile]
+        for start in range(0, len(xs), per_batch):
+            batch_xs = xs[start:start + per_batch]
+            batch = np.stack([band[:, x:x + tile] for x in batch_xs])
+            # Same [0, 1] scaling as the 512 input variant
+            inputs = torch.from_numpy(batch).permute(0, 3, 1, 2).float().div_(255.0)
+            with torch.no_grad():
+                logits = model(inputs.to(device=device, dtype=dtype))
+            probs = torch.sigmoid(logits.float()).cpu().numpy()[:, 0]
+            for x, prob in zip(batch_xs, probs):
+                blended[:, x:x + tile] += prob * weights
+                weight_sum[:, x:x + tile] += weights
+
+        # Rows above the next band's start get no more tiles: emit them
+        done = (ys[row + 1] if row + 1 < len(ys) else y + tile) - y
+        rows = min(done, height - y)
+        if rows > 0:
+            prob_rows = blended[:rows, :width] / weight_sum[:rows, :width]
+            np.multiply(prob_rows > 0.5, 255, out=mask[y:y + rows], casting='unsafe')
+            band_counts, band_sums, band_sums_sq = vessel_mask_moments(prob_rows[None])
+            counts += band_counts[0]
+            total += band_sums[0]
+            total_sq += band_sums_sq[0]
+        blended[:tile - done] = blended[done:]
+        blended[tile - done:] = 0
+        weight_sum[:tile - done] = weight_sum[done:]
+        weight_sum[tile - done:] = 0
+
+    features = vessel_statistics(counts[None], [total], [total_sq])[0]
+    return mask, dict(zip(VESSEL_FEATURE_NAMES, features.tolist()))
+
+
+def tiled_vessel_job(image_bytes: bytes):
+    """Decode an upload at full resolution and segment it tile by tile (runs on the inference pool)"""
+    with timed_stage('decode'):
+        image, _ = decode_image(image_bytes)
+    with timed_stage('segment'), resident_models('vessel') as (model,):
+        return segment_vessels_tiled(model, image)
+
+
+# ==================== WORKER POOLS ====================
+# Blocking work never runs on the asyncio event loop:
+# - decoding, preprocessing and response encoding run on the CPU pool, made of
+#   PREPROCESS_THREADS threads, or PREPROCESS_PROCESSES processes when > 0;
+# - batched forward passes run on INFERENCE_WORKERS threads, each allowed
+#   TORCH_THREADS_PER_WORKER torch intra-op threads.
+# At most MAX_PENDING_REQUESTS /predict calls are admitted at once; the rest
+# are rejected immediately with 503 and a Retry-After of RETRY_AFTER_SECONDS.
+
+CPU_COUNT = os.cpu_count() or 1
+INFERENCE_WORKERS = max(1, _env_number('INFERENCE_WORKERS', 2))
+TORCH_THREADS_PER_WORKER = max(1, _env_number('TORCH_THREADS_PER_WORKER', max(1, CPU_COUNT // INFERENCE_WORKERS)))
+PREPROCESS_THREADS = max(1, _env_number('PREPROCESS_THREADS', 2))
+PREPROCESS_PROCESSES = max(0, _env_number('PREPROCESS_PROCESSES', 0))
+MAX_PENDING_REQUESTS = max(1, _env_number('MAX_PENDING_REQUESTS', 64))
+RETRY_AFTER_SECONDS = max(1, _env_number('RETRY_AFTER_SECONDS', 1))
+
+
+class InferencePool:
+    """Bounded pool of inference threads with a fixed torch intra-op thread budget"""
+
+    def __init__(self, workers: int, torch_threads: int):
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self._slots = threading.BoundedSemaphore(workers)
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _init_worker(self):
+        torch.set_num_threads(self.torch_threads)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="inference",
+                        initializer=self._init_worker,
+                    )
+        return self._executor
+
+    def acquire(self):
+        """Block until a worker is free and reserve it"""
+        self._slots.acquire()
+        with self._busy_lock:
+            self._busy += 1
+
+    def _release(self, _future=None):
+        with self._busy_lock:
+            self._busy -= 1
+        self._slots.release()
+
+    def submit_acquired(self, fn, *args) -> Future:
+        """Run fn on the worker reserved by a previous acquire()"""
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def submit(self, fn, *args) -> Future:
+        """Run fn on the next free worker, blocking the caller while all are busy"""
+        self.acquire()
+        return self.submit_acquired(fn, *args)
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'busy': self._busy,
+            'torch_threads_per_worker': self.torch_threads,
         }
 
 
+inference_pool = InferencePool(INFERENCE_WORKERS, TORCH_THREADS_PER_WORKER)
+
+_cpu_executor = None
+_cpu_executor_lock = threading.Lock()
+
+
+def _init_preprocess_process():
+    # Preprocessing is numpy/PIL only; keep torch from oversubscribing cores
+    torch.set_num_threads(1)
+
+
+def get_cpu_executor():
+    """Executor for decoding, preprocessing and response encoding"""
+    global _cpu_executor
+    if _cpu_executor is None:
+        with _cpu_executor_lock:
+            if _cpu_executor is None:
+                if PREPROCESS_PROCESSES > 0:
+                    _cpu_executor = ProcessPoolExecutor(
+                        max_workers=PREPROCESS_PROCESSES,
+                        initializer=_init_preprocess_process,
+                    )
+                else:
+                    _cpu_executor = ThreadPoolExecutor(
+                        max_workers=PREPROCESS_THREADS,
+                        thread_name_prefix="preprocess",
+                    )
+    return _cpu_executor
+
+
+async def run_blocking(executor, fn, *args):
+    """Run a blocking function on an executor from a coroutine"""
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def run_timed(executor, fn, *args, model: str = ''):
+    """run_blocking, recording the stages fn times for the current request"""
+    result, spans = await run_blocking(executor, collect_spans, fn, *args)
+    record_spans(spans, model)
+    return result
+
+
+# Admission control for /predict
+_admission = threading.BoundedSemaphore(MAX_PENDING_REQUESTS)
+_pending_requests = 0
+
+
+def admit_request() -> bool:
+    """Reserve a /predict slot; False when the server is already saturated"""
+    global _pending_requests
+    if not _admission.acquire(blocking=False):
+        return False
+    _pending_requests += 1
+    return True
+
+
+def release_request():
+    global _pending_requests
+    _pending_requests -= 1
+    _admission.release()
+
+
+class AdmissionMiddleware:
+    """ASGI middleware rejecting prediction requests with 503 while the server is saturated.
+
+    Runs before the endpoint reads (and FastAPI parses) the multipart body,
+    so a rejected request costs no upload handling. Admitted requests hold
+    their slot until the response is sent.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] not in TIMED_ENDPOINTS or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+        if not admit_request():
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server is busy, please retry"},
+                # Sent from outside the CORS middleware, which never sees it
+                headers={
+                    "Retry-After": str(RETRY_AFTER_SECONDS),
+                    "Access-Control-Allow-Origin": "*",
+                    "Access-Control-Expose-Headers": ", ".join(EXPOSED_HEADERS),
+                },
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release_request()
+
+
+app.add_middleware(AdmissionMiddleware)
+# Added last, so it is the outermost middleware and also times and counts rejected requests
+app.add_middleware(RequestTimingMiddleware)
+
+
+def decode_and_preprocess_variants(image_bytes: bytes, sizes):
+    """Decode an uploaded image once and preprocess it for each input size in sizes.
+
+    Runs on the CPU pool, so it must stay a picklable module-level function.
+
+    Returns:
+        ({size: tensor}, original_size)
+    """
+    # Always decode at the scale covering the largest input, so a 224 input
+    # is identical whether or not a 512 one is produced from the same decode
+    with timed_stage('decode'):
+        image, original_size = decode_image(image_bytes, max(INPUT_VARIANTS))
+    with timed_stage('preprocess'):
+        return preprocess_variants(image, sizes), original_size
+
+
+def decode_and_preprocess(image_bytes: bytes, input_size: int):
+    """Decode an uploaded image and preprocess it for a 224 or 512 model input.
+
+    Returns:
+        (tensor, original_size)
+    """
+    tensors, original_size = decode_and_preprocess_variants(image_bytes, (input_size,))
+    return tensors[input_size], original_size
+
+
+# ==================== MICRO-BATCHING ====================
+# Concurrent /predict calls for the same model are queued and executed as one
+# batched forward pass: a batch closes when it reaches BATCH_MAX_SIZE items or
+# when its oldest request has waited BATCH_MAX_WAIT_MS. Both can be overridden
+# per model, e.g. HYPERTENSION_BATCH_MAX_SIZE=8 or FUSION_BATCH_MAX_WAIT_MS=20.
+# The wait only applies while a batch of the same model is already running;
+# otherwise whatever is queued is dispatched at once, so a lone request at low
+# load is not delayed.
+
+BATCH_MAX_SIZE = _env_number('BATCH_MAX_SIZE', 16)
+BATCH_MAX_WAIT_MS = _env_number('BATCH_MAX_WAIT_MS', 10.0, float)
+
+
+class MicroBatcher:
+    """Per-model request queue that runs concurrent requests as one batch"""
+
+    def __init__(self, name: str, batch_fn, max_batch_size: int = 16, max_wait_ms: float = 10.0,
+                 pool: Optional[InferencePool] = None):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.pool = pool
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._running = 0  # batches submitted and not finished
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+        self._max_batch_size_seen = 0
+        self._batch_size_counts = {}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, item) -> Future:
+        """Queue one item; the returned future resolves to its result"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    async def run(self, item):
+        """Queue one item and wait for its result without blocking the event loop.
+
+        The item's queueing time and the stages timed while its batch ran are
+        recorded for the current request.
+        """
+        future = self.submit(item)
+        result = await asyncio.wrap_future(future)
+        record_spans(getattr(future, 'spans', ()), self.name)
+        return result
+
+    def stats(self) -> dict:
+        """Queue depth, batch size and wait time figures for tuning"""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self._batches,
+                'items': self._items,
+                'last_batch_size': self._last_batch_size,
+                'largest_batch_size': self._max_batch_size_seen,
+                'mean_batch_size': self._items / self._batches if self._batches else 0.0,
+                'batch_size_counts': dict(sorted(self._batch_size_counts.items())),
+                'mean_wait_ms': 1000.0 * self._wait_total / self._items if self._items else 0.0,
+                'max_wait_observed_ms': 1000.0 * self._wait_max,
+            }
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._work, name=f"batcher-{self.name}", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self, first):
+        """Gather more requests after the first until the batch is full or the wait expires"""
+        batch = [first]
+        with self._stats_lock:
+            running = self._running
+        # Waiting to fill a batch only pays off while another one is running:
+        # with nothing in flight, take what is queued and go. The wait budget
+        # starts when the oldest request was queued, so a request that already
+        # waited behind a running batch is not delayed again.
+        deadline = batch[0][2] + self.max_wait if running else 0.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            first = self._queue.get()
+            if self.pool is None:
+                batch = self._collect(first)
+                self._set_running(1)
+                self._execute(batch)
+                continue
+            # Wait for a free inference worker before closing the batch, so
+            # requests arriving in the meantime join it instead of queueing.
+            self.pool.acquire()
+            batch = self._collect(first)
+            self._set_running(1)
+            try:
+                self.pool.submit_acquired(self._execute, batch)
+            except BaseException:
+                self._set_running(-1)
+                raise
+
+    def _set_running(self, delta: int):
+        with self._stats_lock:
+            self._running += delta
+
+    def _execute(self, batch):
+        try:
+            self._execute_batch(batch)
+        finally:
+            self._set_running(-1)
+
+    def _execute_batch(self, batch):
+        started = time.perf_counter()
+        # Skip requests whose caller has gone away (e.g. client disconnected)
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        waits = [started - entry[2] for entry in batch]
+        self._record(len(batch), waits)
+
+        try:
+            results, spans = collect_spans(self.batch_fn, [entry[0] for entry in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        spans.append(('inference', time.perf_counter() - started, ''))
+
+        for (_, future, _), result, wait in zip(batch, results, waits):
+            future.spans = [('queue', wait, '')] + spans
+            future.set_result(result)
+
+    def _record(self, batch_size, waits):
+        with self._stats_lock:
+            self._batches += 1
+            self._items += batch_size
+            self._last_batch_size = batch_size
+            self._max_batch_size_seen = max(self._max_batch_size_seen, batch_size)
+            self._batch_size_counts[batch_size] = self._batch_size_counts.get(batch_size, 0) + 1
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+        BATCH_SIZES.observe(batch_size, model=self.name)
+
+
+def _run_grouped(items, shape_of, run_batch):
+    """Run run_batch on groups of items that share a tensor shape, keeping input order"""
+    groups = {}
+    for index, item in enumerate(items):
+        groups.setdefault(shape_of(item), []).append(index)
+
+    results = [None] * len(items)
+    for indices in groups.values():
+        for index, result in zip(indices, run_batch([items[i] for i in indices])):
+            results[index] = result
+    return results
+
+
+_collate_buffers = threading.local()
+
+
+def collate(tensors, slot: str = 'input') -> torch.Tensor:
+    """Concatenate request tensors into this thread's reusable batch buffer for slot.
+
+    The result is overwritten by the next collate on the same thread and slot,
+    so it must not outlive the batch it was built for.
+    """
+    if len(tensors) == 1:
+        return tensors[0]
+    rows = sum(tensor.shape[0] for tensor in tensors)
+    key = (slot, tuple(tensors[0].shape[1:]), tensors[0].dtype)
+    buffers = _collate_buffers.__dict__.setdefault('buffers', {})
+    buffer = buffers.get(key)
+    if buffer is None or buffer.shape[0] < rows:
+        buffer = buffers[key] = torch.empty((rows,) + key[1], dtype=key[2])
+    return torch.cat(tensors, out=buffer[:rows])
+
+
+def _hypertension_batch(items):
+    with resident_models('hypertension') as (model,):
+        return _run_grouped(
+            items,
+            lambda tensor: tuple(tensor.shape),
+            lambda group: predict_hypertension_batch(model, collate(group)),
+        )
+
+
+def _cimt_batch(items):
+    with resident_models('cimt') as (model,):
+        return _run_grouped(
+            items,
+            lambda pair: (tuple(pair[0].shape), tuple(pair[1].shape)),
+            lambda group: predict_cimt_batch(
+                model,
+                collate([left for left, _ in group], 'left'),
+                collate([right for _, right in group], 'right'),
+            ),
+        )
+
+
+def _vessel_batch(items):
+    with resident_models('vessel') as (model,):
+        return _run_grouped(
+            items,
+            lambda tensor: tuple(tensor.shape),
+            lambda group: predict_vessel_batch(model, collate(group)),
+        )
+
+
+def _fusion_batch(items):
+    with resident_models(*MODEL_DEPENDENCIES['fusion']) as (htn_model, cimt_model, vessel_model, fusion_model):
+        return _run_grouped(
+            items,
+            lambda pair: (tuple(pair[0].shape), tuple(pair[1].shape)),
+            lambda group: predict_fusion_batch(
+                collate([left for left, _ in group], 'left'),
+                collate([right for _, right in group], 'right'),
+                htn_model, cimt_model, vessel_model, fusion_model,
+            ),
+        )
+
+
+def _make_batcher(model_name: str, batch_fn) -> MicroBatcher:
+    prefix = model_name.upper()
+    return MicroBatcher(
+        model_name,
+        batch_fn,
+        max_batch_size=_env_number(f'{prefix}_BATCH_MAX_SIZE', BATCH_MAX_SIZE),
+        max_wait_ms=_env_number(f'{prefix}_BATCH_MAX_WAIT_MS', BATCH_MAX_WAIT_MS, float),
+        pool=inference_pool,
+    )
+
+
+# One batcher per model. Items are preprocessed tensors with a batch dimension of 1:
+# hypertension/vessel take an image tensor, cimt/fusion a (left, right) tuple.
+# The vessel batcher returns soft masks; vessel_outputs() does the encoding.
+batchers = {
+    'hypertension': _make_batcher('hypertension', _hypertension_batch),
+    'cimt': _make_batcher('cimt', _cimt_batch),
+    'vessel': _make_batcher('vessel', _vessel_batch),
+    'fusion': _make_batcher('fusion', _fusion_batch),
+}
+
+
+# ==================== RESULT CACHE ====================
+# Finished /predict responses are cached by content: the key is a hash of the
+# uploaded bytes, the model, and the checkpoint version and precision of every
+# model the answer depends on, so replacing a checkpoint never serves stale
+# results. Entries live in memory (LRU within RESULT_CACHE_MB, expiring after
+# RESULT_CACHE_TTL_SECONDS) and, when RESULT_CACHE_DIR is set, also as JSON
+# files there so they survive restarts (pruned to RESULT_CACHE_DISK_MB).
+# RESULT_CACHE_MB=0 disables the cache.
+
+RESULT_CACHE_MB = _env_number('RESULT_CACHE_MB', 64, float)
+RESULT_CACHE_TTL_SECONDS = _env_number('RESULT_CACHE_TTL_SECONDS', 3600, float)
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+RESULT_CACHE_DISK_MB = _env_number('RESULT_CACHE_DISK_MB', 1024, float)
+
+# Models whose checkpoints a /predict answer depends on
+MODEL_DEPENDENCIES = {
+    'hypertension': ['hypertension'],
+    'cimt': ['cimt'],
+    'vessel': ['vessel'],
+    'fusion': ['hypertension', 'cimt', 'vessel', 'fusion'],
+}
+
+
+class BoundedCache:
+    """Thread-safe in-memory LRU cache with a byte budget and optional TTL"""
+    def __init__(self, max_bytes: int, ttl_seconds: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, size: int, expires_at: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        if expires_at is None and self.ttl_seconds:
+            expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class ResultCache(BoundedCache):
+    """BoundedCache of JSON-serializable results with an optional on-disk tier"""
+    def __init__(self, max_bytes: int, ttl_seconds: float, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 0):
+        super().__init__(max_bytes, ttl_seconds)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self._disk_writes = 0
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        value = super().get(key)
+        if value is not None or not self.disk_dir:
+            return value
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires_at'] < time.time():
+            with self._lock:
+                self.expirations += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # Promote to memory; counts as a hit rather than the miss recorded above
+        size = os.path.getsize(path)
+        super().put(key, entry['result'], size, entry['expires_at'])
+        with self._lock:
+            self.misses -= 1
+            self.hits += 1
+            self.disk_hits += 1
+        return entry['result']
+
+    def put(self, key: str, result):
+        encoded = json.dumps(result)
+        expires_at = time.time() + self.ttl_seconds
+        super().put(key, result, len(encoded), expires_at)
+        if self.disk_dir:
+            self._write_disk(key, encoded, expires_at)
+
+    def _write_disk(self, key: str, encoded: str, expires_at: float):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write(f'{{"expires_at": {expires_at!r}, "result": {encoded}}}')
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write result cache entry", extra=log_fields(path=path, error=str(e)))
+            return
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 100 == 0
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        """Delete expired files, then the oldest ones until the disk tier fits its budget"""
+        files = []
+        now = time.time()
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds:
+                    self._remove_file(path)
+                else:
+                    files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(path)
+            total -= size
+            with self._lock:
+                self.disk_evictions += 1
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update({
+            'ttl_seconds': self.ttl_seconds,
+            'disk_dir': self.disk_dir,
+            'disk_hits': self.disk_hits,
+            'disk_evictions': self.disk_evictions,
+        })
+        return stats
+
+
+result_cache = ResultCache(
+    int(RESULT_CACHE_MB * 2 ** 20),
+    RESULT_CACHE_TTL_SECONDS,
+    RESULT_CACHE_DIR,
+    int(RESULT_CACHE_DISK_MB * 2 ** 20),
+)
+
+
+def upload_digest(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def result_cache_key(model_name: str, upload_digests, options: tuple = ()) -> str:
+    """Cache key of a /predict answer; the models' checkpoints must be on disk (not loaded)"""
+    parts = [model_name, *upload_digests]
+    for name in MODEL_DEPENDENCIES[model_name]:
+        parts.append(f"{name}:{checkpoint_version(name)}:{model_precision(name)}")
+    parts.extend(str(option) for option in options)
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+# ==================== EMBEDDING CACHE ====================
+# The base models' contributions to the fusion input (prediction plus
+# return_embedding outputs, see hypertension_features, cimt_features and
+# vessel_features) are cached per input row, keyed by the model, its
+# checkpoint version and precision and a hash of the exact float32 input the
+# model saw. predict_fusion_batch reads and stores them, so fusion only runs
+# the models on inputs it has not seen. Of the /predict base-model calls only
+# hypertension stores its rows: its 224px input is the one fusion feeds it,
+# while cimt and vessel take 512px uploads that fusion never sees.
+# EMBEDDING_CACHE_MB=0 disables the cache.
+
+EMBEDDING_CACHE_MB = _env_number('EMBEDDING_CACHE_MB', 64, float)
+
+embedding_cache = BoundedCache(int(EMBEDDING_CACHE_MB * 2 ** 20))
+
+
+def tensor_digests(tensor: torch.Tensor):
+    """sha256 of each row of a CPU input batch, or None when the embedding cache is off"""
+    if not embedding_cache.enabled:
+        return None
+    array = tensor.detach().cpu().contiguous().numpy()
+    return [hashlib.sha256(memoryview(row)).hexdigest() for row in array]
+
+
+def pair_digests(left: torch.Tensor, right: torch.Tensor):
+    left_digests = tensor_digests(left)
+    if left_digests is None:
+        return None
+    return [f"{l}:{r}" for l, r in zip(left_digests, tensor_digests(right))]
+
+
+def _embedding_keys(model_name: str, digests):
+    if digests is None:
+        return None
+    try:
+        prefix = f"{model_name}:{checkpoint_version(model_name)}:{model_precision(model_name)}"
+    except OSError:
+        # Model not loaded from a checkpoint file; nothing to version it by
+        return None
+    return [f"{prefix}:{digest}" for digest in digests]
+
+
+def store_embeddings(model_name: str, digests, features: np.ndarray):
+    """Cache one fusion feature row per input"""
+    keys = _embedding_keys(model_name, digests)
+    for key, row in zip(keys or [], features):
+        row = np.array(row, dtype=np.float32)
+        embedding_cache.put(key, row, row.nbytes)
+
+
+def cached_embeddings(model_name: str, digests, batch_size: int, compute) -> np.ndarray:
+    """Fusion feature rows for a batch, running compute(rows) only for the rows not cached"""
+    keys = _embedding_keys(model_name, digests)
+    if keys is None:
+        return compute(list(range(batch_size)))
+    rows = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        computed = compute(missing)
+        for i, row in zip(missing, computed):
+            rows[i] = row
+        store_embeddings(model_name, [digests[i] for i in missing], computed)
+    return np.stack(rows)
+
+
+# ==================== WARM-UP ====================
+# With WARMUP_MODELS=1 (the default) the server loads every model in
+# MODEL_PATHS in parallel at startup and runs one dummy forward pass on each,
+# so the first real request does not pay for downloads, unpickling or
+# allocator/kernel warm-up. GET /ready reports 503 until this has finished.
+# With MODEL_MEMORY_BUDGET_MB set, only the models that fit in the budget
+# together are warmed up (in MODEL_PATHS order), one at a time, so warm-up
+# never evicts what it has just loaded; the others load on first use.
+
+WARMUP_MODELS = os.environ.get('WARMUP_MODELS', '1') != '0'
+
+def _dummy_forward(model_name: str, model):
+    """Run one forward pass on zeros, shaped like /predict inputs, to warm up allocator and kernels"""
+    device, dtype = model_input_spec(model)
+    with torch.no_grad():
+        if model_name == 'hypertension':
+            model(torch.zeros(1, 3, 224, 224, device=device, dtype=dtype), return_embedding=True)
+        elif model_name == 'vessel':
+            model(torch.zeros(1, 3, 512, 512, device=device, dtype=dtype), return_embedding=True)
+        elif model_name == 'cimt':
+            image = torch.zeros(1, 3, 512, 512, device=device, dtype=dtype)
+            model(image, image, to_model_input(dummy_clinical_features(1), model), return_embedding=True)
+        elif model_name == 'fusion':
+            model(torch.zeros(1, 1425, device=device, dtype=dtype))
+
+
+warmup_state = {
+    'status': 'pending' if WARMUP_MODELS else 'disabled',
+    'models': {name: {'status': 'pending'} for name in MODEL_PATHS},
+}
+
+
+def _warmup_one(model_name: str):
+    entry = warmup_state['models'][model_name]
+    entry['status'] = 'loading'
+    start = time.perf_counter()
+    try:
+        model = load_model(model_name)
+        entry['load_seconds'] = round(time.perf_counter() - start, 3)
+        entry['status'] = 'warming'
+        forward_start = time.perf_counter()
+        _dummy_forward(model_name, model)
+        entry['forward_seconds'] = round(time.perf_counter() - forward_start, 3)
+        entry['status'] = 'ready'
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = str(e)
+        logger.error("Warm-up failed", extra=log_fields(model=model_name, error=str(e)))
+
+
+def warmup_plan() -> list:
+    """Models to warm up: all of them, or those that fit in the model memory budget together"""
+    if not residency.enabled:
+        return list(MODEL_PATHS)
+    selected, total = [], 0
+    for name in MODEL_PATHS:
+        size = estimate_model_bytes(name)
+        if total + size <= residency.budget_bytes:
+            selected.append(name)
+            total += size
+    return selected
+
+
+def warmup_models():
+    """Load and warm up the models of warmup_plan(), in parallel unless under a memory budget"""
+    warmup_state['status'] = 'warming'
+    start = time.perf_counter()
+    names = warmup_plan()
+    for name in MODEL_PATHS:
+        if name not in names:
+            warmup_state['models'][name] = {'status': 'skipped', 'reason': 'memory budget'}
+    if names:
+        workers = 1 if residency.enabled else len(names)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warmup") as executor:
+            list(executor.map(_warmup_one, names))
+    warmup_state['seconds'] = round(time.perf_counter() - start, 3)
+    failed = [name for name, entry in warmup_state['models'].items() if entry['status'] not in ('ready', 'skipped')]
+    warmup_state['status'] = 'failed' if failed else 'ready'
+    logger.info("Model warm-up finished", extra=log_fields(
+        status=warmup_state['status'], seconds=warmup_state['seconds']
+    ))
+
+
+def is_ready() -> bool:
+    """True once warm-up has finished, or every model has been loaded since"""
+    if warmup_state['status'] in ('ready', 'disabled'):
+        return True
+    return all(name in models for name in MODEL_PATHS)
+
+
+@app.on_event("startup")
+def start_warmup():
+    if WARMUP_MODELS:
+        # Run in the background so /health answers while models load
+        threading.Thread(target=warmup_models, name="warmup", daemon=True).start()
+
+
 # ==================== API ENDPOINTS ====================
 
 @app.get("/")
@@ -612,6 +2788,240 @@ def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/ready")
+def readiness_check():
+    """Readiness for load balancers: 503 until the models are loaded and warm"""
+    status_code = 200 if is_ready() else 503
+    return JSONResponse(
+        status_code=status_code,
+        content={"status": "ready" if status_code == 200 else "not ready", "warmup": warmup_state},
+    )
+
+
+@app.get("/stats")
+def stats():
+    """Micro-batching figures per model (queue depth, batch sizes, wait times)"""
+    return {
+        "pending_requests": _pending_requests,
+        "max_pending_requests": MAX_PENDING_REQUESTS,
+        "inference_pool": inference_pool.stats(),
+        "batching": {name: batcher.stats() for name, batcher in batchers.items()},
+        "result_cache": result_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "model_residency": residency.stats(),
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: stage and request latency histograms, counters, batching and cache figures"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def _batcher_stat(key):
+    return lambda: {(name,): batcher.stats()[key] for name, batcher in batchers.items()}
+
+
+def _cache_stat(key):
+    return lambda: {(name,): cache.stats()[key] for name, cache in
+                    (('result', result_cache), ('embedding', embedding_cache))}
+
+
+CollectedMetric('cvd_in_flight_requests', 'Prediction requests being handled', 'gauge', (),
+                lambda: {(): _pending_requests})
+CollectedMetric('cvd_max_in_flight_requests', 'Admission limit (MAX_PENDING_REQUESTS)', 'gauge', (),
+                lambda: {(): MAX_PENDING_REQUESTS})
+CollectedMetric('cvd_inference_workers_busy', 'Inference workers running a batch', 'gauge', (),
+                lambda: {(): inference_pool.stats()['busy']})
+CollectedMetric('cvd_models_loaded', 'Models loaded in memory', 'gauge', ('model',),
+                lambda: {(name,): int(name in models) for name in MODEL_PATHS})
+CollectedMetric('cvd_model_resident_bytes', 'Estimated weight memory of a loaded model', 'gauge', ('model',),
+                lambda: {(name,): entry['bytes'] for name, entry in residency.stats()['models'].items()})
+CollectedMetric('cvd_model_memory_budget_bytes', 'Model memory budget (MODEL_MEMORY_BUDGET_MB, 0 = none)',
+                'gauge', (), lambda: {(): residency.budget_bytes})
+CollectedMetric('cvd_model_evictions_total', 'Models evicted to stay within the memory budget', 'counter',
+                ('model',), lambda: {(name,): residency.evictions[name] for name in MODEL_PATHS})
+CollectedMetric('cvd_model_reloads_total', 'Loads of models that had been evicted', 'counter', ('model',),
+                lambda: {(name,): residency.reloads[name] for name in MODEL_PATHS})
+CollectedMetric('cvd_batch_queue_depth', 'Requests waiting in a micro-batcher queue', 'gauge', ('model',),
+                _batcher_stat('queue_depth'))
+CollectedMetric('cvd_batches_total', 'Batched forward passes run', 'counter', ('model',),
+                _batcher_stat('batches'))
+CollectedMetric('cvd_batch_items_total', 'Requests run through a micro-batcher', 'counter', ('model',),
+                _batcher_stat('items'))
+CollectedMetric('cvd_cache_hits_total', 'Cache hits', 'counter', ('cache',), _cache_stat('hits'))
+CollectedMetric('cvd_cache_misses_total', 'Cache misses', 'counter', ('cache',), _cache_stat('misses'))
+CollectedMetric('cvd_cache_evictions_total', 'Cache evictions', 'counter', ('cache',), _cache_stat('evictions'))
+CollectedMetric('cvd_cache_bytes', 'Bytes held in memory by a cache', 'gauge', ('cache',), _cache_stat('bytes'))
+
+
+# Input size each model takes from each upload: (image,) or (left, right)
+MODEL_INPUT_SIZES = {
+    'hypertension': (224,),
+    'vessel': (512,),
+    'cimt': (512, 512),
+    'fusion': (224, 224),
+}
+
+
+async def ensure_models_loaded(model_names):
+    """Load models for a request; callers pin them (pinned_models) until the answer is ready"""
+    try:
+        with timed_stage('load_model'):
+            for name in model_names:
+                await load_model_async(name)
+    except Exception as e:
+        annotate_request(error='model_loading')
+        raise HTTPException(status_code=500, detail=f"Model loading error: {str(e)}")
+
+
+async def upload_digests(uploads):
+    """sha256 of each upload, or None when the result cache is off"""
+    if not result_cache.enabled:
+        return None
+    with timed_stage('hash'):
+        return await asyncio.gather(*(run_blocking(None, upload_digest, data) for data in uploads))
+
+
+async def lookup_result(model_name: str, digests, options: tuple = ()):
+    """(cache key, cached result or None) for a model on the given uploads"""
+    if digests is None:
+        return None, None
+    try:
+        cache_key = result_cache_key(model_name, digests, options)
+    except FileNotFoundError:
+        # A checkpoint is not downloaded yet, so nothing can be cached for it
+        return None, None
+    with timed_stage('cache_lookup', model_name):
+        cached = await run_blocking(None, result_cache.get, cache_key)
+    return cache_key, (cached_response(cached) if cached is not None else None)
+
+
+async def store_result(cache_key, result):
+    if cache_key is None:
+        return
+    if isinstance(result, Response):
+        # Binary bodies are cached as base64 inside a JSON-serializable entry
+        result = {'__response__': {
+            'media_type': result.media_type,
+            'headers': {name: value for name, value in result.headers.items() if name.startswith('x-')},
+            'body': base64.b64encode(result.body).decode(),
+        }}
+    await run_blocking(None, result_cache.put, cache_key, result)
+
+
+def cached_response(cached):
+    """Turn a result-cache entry back into what the endpoint returns"""
+    if isinstance(cached, dict) and '__response__' in cached:
+        entry = cached['__response__']
+        return Response(
+            content=base64.b64decode(entry['body']),
+            media_type=entry['media_type'],
+            headers=entry['headers'],
+        )
+    return cached
+
+
+DEFAULT_VESSEL_FORMAT = ('json', 'original', 'resized')
+VESSEL_SEGMENTATIONS = ('resized', 'tiled')
+
+# Accept header media types that select a vessel format
+_VESSEL_MEDIA_TYPES = {
+    'application/json': 'json',
+    'image/png': 'png',
+    'application/octet-stream': 'packbits',
+    'multipart/mixed': 'multipart',
+}
+
+
+def negotiate_vessel_format(form, accept: str):
+    """(format, mask_resolution, segmentation) for a vessel result from the form and Accept header"""
+    fmt = form.get('format')
+    if not fmt:
+        # First listed media type we can produce; */* and others mean JSON
+        media_types = [part.split(';')[0].strip().lower() for part in accept.split(',')]
+        fmt = next((_VESSEL_MEDIA_TYPES[t] for t in media_types if t in _VESSEL_MEDIA_TYPES), 'json')
+    resolution = form.get('mask_resolution') or 'original'
+    if fmt not in VESSEL_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {fmt} (use one of {', '.join(VESSEL_FORMATS)})")
+    if resolution not in VESSEL_MASK_RESOLUTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid mask_resolution: {resolution} (use one of {', '.join(VESSEL_MASK_RESOLUTIONS)})"
+        )
+    segmentation = form.get('segmentation') or 'resized'
+    if segmentation not in VESSEL_SEGMENTATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid segmentation: {segmentation} (use one of {', '.join(VESSEL_SEGMENTATIONS)})"
+        )
+    if segmentation == 'tiled' and resolution == 'model':
+        # A tiled mask is segmented at the upload's own resolution; there is no model-sized mask
+        raise HTTPException(status_code=400, detail="mask_resolution=model cannot be combined with segmentation=tiled")
+    return fmt, resolution, segmentation
+
+
+def _response(parts):
+    """Endpoint return value for an encode_vessel_result result"""
+    if isinstance(parts, dict):
+        return parts
+    media_type, body, headers = parts
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def _run_on_inference_pool(fn, *args):
+    return inference_pool.submit(fn, *args).result()
+
+
+async def predict_vessel_tiled(image_bytes: bytes, fmt: str):
+    """Full-resolution tiled vessel segmentation of one upload (segmentation=tiled)"""
+    (mask, features), spans = await run_blocking(
+        None, _run_on_inference_pool, collect_spans, tiled_vessel_job, image_bytes
+    )
+    record_spans(spans, 'vessel')
+    with timed_stage('encode', 'vessel'):
+        parts = await run_blocking(
+            get_cpu_executor(), encode_vessel_result, Image.fromarray(mask, mode='L'), features, fmt
+        )
+    return _response(parts)
+
+
+async def run_prediction(model_name: str, tensors, original_sizes, vessel_format=DEFAULT_VESSEL_FORMAT):
+    """Run one model on its preprocessed inputs and build its API response.
+
+    Requests are queued on the model's micro-batcher and run together with
+    concurrent requests. vessel_format is (format, mask_resolution) for the
+    vessel model; non-JSON formats return a Response.
+    """
+    if model_name == 'hypertension':
+        prediction, confidence = await batchers['hypertension'].run(tensors[0])
+        return {
+            'prediction': prediction,
+            'confidence': confidence
+        }
+    
+    elif model_name == 'cimt':
+        value = await batchers['cimt'].run(tuple(tensors))
+        return {
+            'prediction': value,
+            'value': value
+        }
+    
+    elif model_name == 'vessel':
+        prob_mask = await batchers['vessel'].run(tensors[0])
+        fmt, mask_resolution, _ = vessel_format
+        parts = await run_timed(
+            get_cpu_executor(), vessel_response_parts, prob_mask, original_sizes[0], fmt, mask_resolution,
+            model='vessel',
+        )
+        return _response(parts)
+    
+    elif model_name == 'fusion':
+        return await batchers['fusion'].run(tuple(tensors))
+    
+    raise HTTPException(status_code=400, detail="Unknown model type")
+
+
 @app.post("/predict")
 async def predict(
     request: Request,
@@ -621,20 +3031,28 @@ async def predict(
     
     For hypertension and vessel: requires 'image' (single eye)
     For cimt and fusion: requires 'left_image' and 'right_image' (both eyes)
+    
+    Vessel results are JSON with a base64 PNG mask by default; 'format'
+    (json, png, packbits, multipart) or the Accept header selects a binary
+    response and mask_resolution=model returns the 512x512 mask unresized.
+    segmentation=tiled segments the vessel image at native resolution (its mask
+    is always at the upload's size, so mask_resolution=model is rejected).
     """
     
     if model not in MODEL_PATHS:
         raise HTTPException(status_code=400, detail=f"Invalid model: {model}")
+    annotate_request(model=model)
     
     try:
-        print(f"\n{'='*50}")
-        print(f"PREDICTION REQUEST RECEIVED")
-        print(f"Model: {model}")
-        print(f"{'='*50}\n")
-        
         # Parse form data manually to handle optional files
         form = await request.form()
         
+        # Vessel output format: 'format' form field, else the Accept header
+        vessel_format = DEFAULT_VESSEL_FORMAT
+        if model == 'vessel':
+            vessel_format = negotiate_vessel_format(form, request.headers.get('accept', ''))
+        result_options = () if vessel_format == DEFAULT_VESSEL_FORMAT else vessel_format
+        
         # Determine which models need 2 images vs 1 image
         needs_two_images = model in ['cimt', 'fusion']
         
@@ -655,23 +3073,13 @@ async def predict(
                     detail=f"Model '{model}' requires both left_image and right_image files"
                 )
             
-            print(f"Left Image: {left_image.filename}")
-            print(f"Right Image: {right_image.filename}")
+            annotate_request(files=[left_image.filename, right_image.filename])
             
-            # Read and process both images
+            # Read both images
             left_bytes = await left_image.read()
             right_bytes = await right_image.read()
             
-            left_pil = Image.open(io.BytesIO(left_bytes))
-            right_pil = Image.open(io.BytesIO(right_bytes))
-            
-            # Preprocess both images
-            if model == 'cimt':
-                left_tensor = preprocess_image_512(left_pil)
-                right_tensor = preprocess_image_512(right_pil)
-            else:  # fusion
-                left_tensor = preprocess_image(left_pil, target_size=(224, 224))
-                right_tensor = preprocess_image(right_pil, target_size=(224, 224))
+            uploads = [left_bytes, right_bytes]
             
         else:
             # Hypertension and Vessel require single image
@@ -689,71 +3097,173 @@ async def predict(
                     detail=f"Model '{model}' requires a valid image file"
                 )
             
-            print(f"Image: {image.filename}")
+            annotate_request(files=[image.filename])
             
-            # Read and process single image
+            # Read single image
             image_bytes = await image.read()
-            image_pil = Image.open(io.BytesIO(image_bytes))
-            original_image = image_pil.copy()
-            
-            # Preprocess image based on model type
-            if model == 'vessel':
-                image_tensor = preprocess_image_512(image_pil)
-            else:  # hypertension
-                image_tensor = preprocess_image(image_pil, target_size=(224, 224))
+            uploads = [image_bytes]
         
-        # Load model
-        try:
-            model_obj = load_model(model)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Model loading error: {str(e)}")
+        # Everything up to here: receiving and parsing the multipart upload
+        record_stage('parse', request_elapsed())
         
-        # Make prediction based on model type
-        if model == 'hypertension':
-            prediction, confidence = predict_hypertension(model_obj, image_tensor)
-            return {
-                'prediction': prediction,
-                'confidence': confidence
-            }
+        # Answer exact repeats from the result cache, without loading any model
+        digests = await upload_digests(uploads)
+        cache_key, cached = await lookup_result(model, digests, result_options)
+        annotate_request(cache='miss' if digests else 'off')
+        if cached is not None:
+            annotate_request(cache='hit')
+            return cached
         
-        elif model == 'cimt':
-            value = predict_cimt(model_obj, left_tensor, right_tensor)
-            return {
-                'prediction': value,
-                'value': value
-            }
+        # Load model (fusion also needs all three base models), kept resident until answered
+        with pinned_models(MODEL_DEPENDENCIES[model]):
+            await ensure_models_loaded(MODEL_DEPENDENCIES[model])
+            if digests and cache_key is None:
+                # The checkpoints were only just downloaded
+                cache_key = result_cache_key(model, digests, result_options)
+            
+            if vessel_format[2] == 'tiled':
+                # Native resolution: the upload is decoded in full by the tiling job
+                result = await predict_vessel_tiled(uploads[0], vessel_format[0])
+                await store_result(cache_key, result)
+                return result
+            
+            # Decode and preprocess on the CPU pool based on model type
+            decoded = await asyncio.gather(*(
+                run_timed(get_cpu_executor(), decode_and_preprocess, data, input_size)
+                for data, input_size in zip(uploads, MODEL_INPUT_SIZES[model])
+            ))
+            tensors, original_sizes = zip(*decoded)
+            
+            result = await run_prediction(model, tensors, original_sizes, vessel_format)
+        await store_result(cache_key, result)
+        return result
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        annotate_request(error=type(e).__name__)
+        logger.exception("Prediction failed", extra=log_fields(model=model, error=str(e)))
+        raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
+
+
+@app.post("/predict/multi")
+async def predict_multi(request: Request):
+    """Run several models on one upload of the eye images
+    
+    Form fields:
+    - models: comma-separated model names (or repeated field), default all
+    - left_image: left eye (also accepted as 'image' when no model needs both eyes)
+    - right_image: right eye, required for cimt and fusion
+    
+    Each image is decoded once and preprocessed once per input size; the
+    single-eye models use the left image. Independent models run
+    concurrently, and fusion reuses the hypertension embedding computed in
+    the same request. Returns {"results": {model: result}}, each result
+    shaped like the /predict response for that model.
+    """
+    form = await request.form()
+    annotate_request(model='multi')
+    requested = [
+        name.strip()
+        for value in (form.getlist('models') or [','.join(MODEL_PATHS)])
+        for name in value.split(',') if name.strip()
+    ]
+    invalid = [name for name in requested if name not in MODEL_PATHS]
+    if invalid or not requested:
+        raise HTTPException(status_code=400, detail=f"Invalid models: {', '.join(invalid) or '(none)'}")
+    requested = list(dict.fromkeys(requested))
+    annotate_request(models=requested)
+    
+    left_image = form.get('left_image') or form.get('image')
+    right_image = form.get('right_image')
+    needs_two_images = any(len(MODEL_INPUT_SIZES[name]) == 2 for name in requested)
+    if not hasattr(left_image, 'filename'):
+        raise HTTPException(status_code=400, detail="A left_image (or image) file is required")
+    if needs_two_images and not hasattr(right_image, 'filename'):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Models {', '.join(requested)} require both left_image and right_image files"
+        )
+    
+    try:
+        uploads = [await left_image.read()]
+        if needs_two_images:
+            uploads.append(await right_image.read())
+        record_stage('parse', request_elapsed())
         
-        elif model == 'vessel':
-            masked_image, vessel_features = predict_vessel(model_obj, image_tensor, original_image)
-            return {
-                'masked_image': masked_image,
-                'features': vessel_features
-            }
+        # Cached answers first, without loading any model; every upload digest is computed once
+        digests = await upload_digests(uploads)
+        results, cache_keys = {}, {}
+        for name in requested:
+            model_digests = digests[:len(MODEL_INPUT_SIZES[name])] if digests else None
+            cache_keys[name], cached = await lookup_result(name, model_digests)
+            if cached is not None:
+                results[name] = cached
+        pending = [name for name in requested if name not in results]
+        annotate_request(cache_hits=[name for name in requested if name in results])
         
-        elif model == 'fusion':
-            # Fusion model needs all three base models
-            htn_model = load_model('hypertension')
-            cimt_model = load_model('cimt')
-            vessel_model = load_model('vessel')
-            result = predict_fusion(left_tensor, right_tensor, htn_model, cimt_model, vessel_model, model_obj)
-            return result
+        if pending:
+            # Load what the pending models need, kept resident until they are answered
+            dependencies = list(dict.fromkeys(
+                dependency for name in pending for dependency in MODEL_DEPENDENCIES[name]
+            ))
+            with pinned_models(dependencies):
+                await ensure_models_loaded(dependencies)
+                for name in pending:
+                    if digests and cache_keys[name] is None:
+                        # The checkpoints were only just downloaded
+                        cache_keys[name] = result_cache_key(name, digests[:len(MODEL_INPUT_SIZES[name])])
+                
+                # Decode each upload once, with every input size the pending models need
+                sizes = [
+                    sorted({MODEL_INPUT_SIZES[name][i] for name in pending if len(MODEL_INPUT_SIZES[name]) > i})
+                    for i in range(len(uploads))
+                ]
+                decoded = await asyncio.gather(*(
+                    run_timed(get_cpu_executor(), decode_and_preprocess_variants, data, upload_sizes)
+                    for data, upload_sizes in zip(uploads, sizes) if upload_sizes
+                ))
+                
+                async def run_one(name):
+                    if name == 'fusion' and 'hypertension' in tasks:
+                        # Let fusion pick the HTN embedding up from the embedding cache
+                        await asyncio.wait([tasks['hypertension']])
+                    input_sizes = MODEL_INPUT_SIZES[name]
+                    tensors = [decoded[i][0][size] for i, size in enumerate(input_sizes)]
+                    original_sizes = [decoded[i][1] for i in range(len(input_sizes))]
+                    result = await run_prediction(name, tensors, original_sizes)
+                    await store_result(cache_keys[name], result)
+                    return result
+                
+                tasks = {}
+                for name in pending:
+                    tasks[name] = asyncio.ensure_future(run_one(name))
+                for name, result in zip(pending, await asyncio.gather(*tasks.values())):
+                    results[name] = result
         
-        else:
-            raise HTTPException(status_code=400, detail="Unknown model type")
+        return {'results': {name: results[name] for name in requested}}
     
+    except HTTPException:
+        raise
     except Exception as e:
-        import traceback
-        error_traceback = traceback.format_exc()
-        print(f"\n{'='*50}")
-        print(f"ERROR OCCURRED!")
-        print(f"Error Type: {type(e).__name__}")
-        print(f"Error Message: {str(e)}")
-        print(f"\nFull Traceback:")
-        print(error_traceback)
-        print(f"{'='*50}\n")
+        annotate_request(error=type(e).__name__)
+        logger.exception("Multi-model prediction failed", extra=log_fields(models=requested, error=str(e)))
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
 
+if os.path.exists(static_dir):
+    @app.get("/{full_path:path}")
+    async def serve_frontend(full_path: str):
+        # Don't intercept API routes
+        if full_path.startswith("api") or full_path.startswith("predict") or full_path.startswith("health") or full_path.startswith("ready"):
+            raise HTTPException(status_code=404, detail="Not found")
+        # Serve index.html for React Router
+        index_path = os.path.join(static_dir, "index.html")
+        if os.path.exists(index_path):
+            return FileResponse(index_path)
+        raise HTTPException(status_code=404, detail="Frontend not found")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,234 @@
+"""
+Serve the API from several worker processes that share one copy of the weights.
+
+`uvicorn --workers N` starts N independent processes and each of them loads
+every model, so memory grows by the full weight footprint (ViT-large,
+seresnext50, UNet, fusion head) per worker. Here the parent process loads
+the models once, freezes its heap and then forks the workers: they serve
+from the copy-on-write pages they inherited, so the weights stay shared and
+read-only, and each extra worker costs little more than its activations,
+caches and interpreter state.
+
+    python prefork.py --workers 4 --port 8000
+    WEB_WORKERS=4 python app.py                 (from the repository root)
+    python prefork.py --report <server pid>
+
+All workers accept connections on one socket bound by the parent. A worker
+that dies is replaced by a new fork of the parent; SIGTERM or SIGINT stops
+them all. The parent logs a memory report (RSS, PSS and unique RSS per
+process, from /proc/<pid>/smaps_rollup) once the workers are up and on
+SIGUSR1; --report prints the same for a running server. Linux only.
+"""
+import argparse
+import gc
+import importlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+logger = logging.getLogger('cvd_risk')
+
+# Seconds the workers get to start before the first memory report
+REPORT_DELAY_SECONDS = 30.0
+
+
+def import_app(app_path: str):
+    """('module:attribute') -> (module, ASGI app)"""
+    module_name, _, attribute = app_path.partition(':')
+    module = importlib.import_module(module_name)
+    return module, getattr(module, attribute or 'app')
+
+
+def preload(module) -> int:
+    """Load every model in the parent process, before any worker exists.
+
+    Returns the torch intra-op thread count to restore in the workers.
+    """
+    import torch
+
+    threads = torch.get_num_threads()
+    # Keep the parent from starting an OpenMP thread pool: a pool created
+    # before fork() is unusable in the children
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    for name in module.MODEL_PATHS:
+        module.load_model(name)
+    # Everything allocated so far lives as long as the parent. Freezing it
+    # keeps the workers' garbage collector from writing to (and so copying)
+    # the pages those objects live on.
+    gc.collect()
+    gc.freeze()
+    logger.info("Preloaded models for forked workers", extra=module.log_fields(
+        models=list(module.MODEL_PATHS), seconds=round(time.perf_counter() - start, 3)
+    ))
+    return threads
+
+
+def worker_main(module, app, sock: socket.socket, workers: int, torch_threads: int, log_level: str):
+    """Body of a forked worker: serve the app on the inherited socket until told to stop"""
+    import torch
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGALRM):
+        signal.signal(signum, signal.SIG_DFL)
+    torch.set_num_threads(torch_threads)
+    if not os.environ.get('TORCH_THREADS_PER_WORKER'):
+        # The cores are shared by every worker process's inference threads
+        module.inference_pool.torch_threads = max(
+            1, (os.cpu_count() or 1) // (workers * module.inference_pool.workers)
+        )
+    config = uvicorn.Config(app, log_level=log_level, lifespan='on')
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+# ==================== MEMORY REPORT ====================
+
+def memory_usage(pid: int) -> dict:
+    """RSS, PSS, unique (private) and shared memory of a process in MiB"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            parts = value.split()
+            if len(parts) == 2 and parts[1] == 'kB':
+                fields[key] = int(parts[0]) / 1024.0
+    return {
+        'rss_mb': fields.get('Rss', 0.0),
+        'pss_mb': fields.get('Pss', 0.0),
+        'uss_mb': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0),
+        'shared_mb': fields.get('Shared_Clean', 0.0) + fields.get('Shared_Dirty', 0.0),
+    }
+
+
+def child_pids(parent_pid: int):
+    """Direct children of a process, from the parent pid field of /proc/<pid>/stat"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; fields resume after its ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == parent_pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def memory_report(parent_pid: int, worker_pids) -> str:
+    """Per-process memory table; the PSS total is the real footprint of the server"""
+    rows = [('parent', parent_pid)] + [(f'worker {i}', pid) for i, pid in enumerate(worker_pids, 1)]
+    lines = [f"{'process':10s} {'pid':>7s} {'rss MiB':>9s} {'pss MiB':>9s} {'uss MiB':>9s} {'shared MiB':>10s}"]
+    totals = {'rss_mb': 0.0, 'pss_mb': 0.0, 'uss_mb': 0.0}
+    worker_uss = []
+    for role, pid in rows:
+        try:
+            usage = memory_usage(pid)
+        except OSError:
+            continue
+        for key in totals:
+            totals[key] += usage[key]
+        if role != 'parent':
+            worker_uss.append(usage['uss_mb'])
+        lines.append(f"{role:10s} {pid:7d} {usage['rss_mb']:9.0f} {usage['pss_mb']:9.0f} "
+                     f"{usage['uss_mb']:9.0f} {usage['shared_mb']:10.0f}")
+    lines.append(f"{'total':10s} {'':7s} {totals['rss_mb']:9.0f} {totals['pss_mb']:9.0f} {totals['uss_mb']:9.0f}")
+    if worker_uss:
+        lines.append(f"unique memory per worker: mean {sum(worker_uss) / len(worker_uss):.0f} MiB, "
+                     f"max {max(worker_uss):.0f} MiB; total footprint (PSS) {totals['pss_mb']:.0f} MiB")
+    return '\n'.join(lines)
+
+
+# ==================== SUPERVISOR ====================
+
+def serve(app_path: str = 'main:app', host: str = '0.0.0.0', port: int = 8000, workers: int = 2,
+          log_level: str = 'info'):
+    """Preload the models, fork workers sharing them and supervise the workers"""
+    module, app = import_app(app_path)
+    torch_threads = preload(module)
+
+    sock = socket.create_server((host, port), backlog=2048)
+    sock.set_inheritable(True)
+    children = {}
+    stopping = False
+
+    def spawn(slot: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                worker_main(module, app, sock, workers, torch_threads, log_level)
+            except BaseException:
+                logger.exception("Worker crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (slot, time.monotonic())
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report(_signum=None, _frame=None):
+        logger.info("Worker memory\n" + memory_report(os.getpid(), sorted(children)))
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, report)
+
+    for slot in range(workers):
+        spawn(slot)
+    logger.info("Forked workers", extra=module.log_fields(
+        workers=workers, pids=sorted(children), address=f"{host}:{port}"
+    ))
+    signal.signal(signal.SIGALRM, report)
+    signal.alarm(int(REPORT_DELAY_SECONDS))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot, started = children.pop(pid, (None, None))
+        if slot is None or stopping:
+            continue
+        logger.warning("Worker exited, starting a new one", extra=module.log_fields(
+            pid=pid, status=os.waitstatus_to_exitcode(status)
+        ))
+        # Do not spin when workers die right after starting
+        if time.monotonic() - started < 5.0:
+            time.sleep(5.0)
+        if not stopping:
+            spawn(slot)
+    sock.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='main:app', help='ASGI app to serve, as module:attribute')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', 2)))
+    parser.add_argument('--log-level', default='info')
+    parser.add_argument('--report', type=int, metavar='PID', help='Print the memory report of a running server')
+    args = parser.parse_args()
+
+    if args.report:
+        print(memory_report(args.report, child_pids(args.report)))
+        return
+    serve(args.app, args.host, args.port, max(1, args.workers), args.log_level)
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,236 @@
+"""
+Score a manifest of fundus image pairs offline.
+
+Reads a CSV or Parquet manifest with one row per patient (an id and the left
+and right image paths), decodes and preprocesses images in worker processes
+while the models run, scores rows in large batches with the predict_*_batch
+functions from main.py and appends one JSON line per row to the output file.
+
+    python score_bulk.py manifest.csv scores.jsonl
+    python score_bulk.py archive.parquet scores.jsonl --models hypertension fusion \
+        --batch-size 32 --workers 4 --image-root /data/fundus
+
+The output file is the checkpoint: it is flushed after every batch, and a
+rerun with the same output skips the ids already in it, so a killed job
+resumes where it stopped. Rows whose images cannot be read get an "error"
+entry instead of scores. Single-eye models (hypertension, vessel) use the
+left image. Parquet manifests need pandas with pyarrow installed.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+import main
+
+
+def read_manifest(path, id_column, left_column, right_column, image_root=None):
+    """Manifest rows as dicts with id, left and right (right may be None)"""
+    if path.lower().endswith(('.parquet', '.pq')):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise SystemExit("Reading Parquet manifests requires pandas and pyarrow (pip install pandas pyarrow)")
+        records = pd.read_parquet(path).to_dict('records')
+    else:
+        with open(path, newline='') as f:
+            records = list(csv.DictReader(f))
+
+    def resolve(value):
+        if value is None or value != value or value == '':  # missing or NaN
+            return None
+        value = str(value)
+        return os.path.join(image_root, value) if image_root and not os.path.isabs(value) else value
+
+    rows = []
+    for index, record in enumerate(records):
+        row_id = record.get(id_column)
+        rows.append({
+            'id': str(index if row_id is None or row_id != row_id else row_id),
+            'left': resolve(record.get(left_column)),
+            'right': resolve(record.get(right_column)),
+        })
+    return rows
+
+
+def completed_ids(output_path):
+    """Ids already scored in an output file; drops a partial last line left by a kill"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        valid_end = 0
+        for line in f:
+            try:
+                done.add(json.loads(line)['id'])
+            except (ValueError, KeyError):
+                break
+            valid_end += len(line)
+        f.truncate(valid_end)
+    return done
+
+
+def load_row(row, sizes):
+    """Read and preprocess one manifest row in a worker process.
+
+    sizes is ((left sizes), (right sizes)). Returns (row, eyes, error) where
+    eyes holds ({size: array}, original_size) per eye.
+    """
+    eyes = []
+    try:
+        for path, eye_sizes in zip((row['left'], row['right']), sizes):
+            if not eye_sizes:
+                break
+            if path is None:
+                raise ValueError("missing image path")
+            with open(path, 'rb') as f:
+                tensors, original_size = main.decode_and_preprocess_variants(f.read(), eye_sizes)
+            # numpy arrays pickle without torch's shared-memory file descriptors
+            eyes.append(({size: tensor.numpy() for size, tensor in tensors.items()}, original_size))
+    except Exception as e:
+        return row, None, f"{type(e).__name__}: {e}"
+    return row, eyes, None
+
+
+def prefetch(executor, rows, sizes, depth):
+    """Yield load_row results in manifest order, keeping depth rows in flight"""
+    rows = iter(rows)
+    pending = deque(executor.submit(load_row, row, sizes) for row in itertools.islice(rows, depth))
+    while pending:
+        result = pending.popleft().result()
+        for row in itertools.islice(rows, 1):
+            pending.append(executor.submit(load_row, row, sizes))
+        yield result
+
+
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def eye_batch(loaded, eye, size):
+    return torch.from_numpy(np.concatenate([eyes[eye][0][size] for _, eyes, _ in loaded]))
+
+
+def score_batch(loaded, model_names, mask_dir=None):
+    """Scores for rows that loaded successfully, one dict per row"""
+    scores = [{} for _ in loaded]
+    # Hypertension before fusion so fusion finds its embeddings in the embedding cache
+    for name in model_names:
+        sizes = main.MODEL_INPUT_SIZES[name]
+        inputs = [eye_batch(loaded, eye, size) for eye, size in enumerate(sizes)]
+        if name == 'hypertension':
+            results = main.predict_hypertension_batch(main.load_model(name), *inputs)
+            for score, (prediction, confidence) in zip(scores, results):
+                score[name] = {'prediction': prediction, 'confidence': confidence}
+        elif name == 'cimt':
+            for score, value in zip(scores, main.predict_cimt_batch(main.load_model(name), *inputs)):
+                score[name] = {'prediction': value, 'value': value}
+        elif name == 'vessel':
+            masks = main.predict_vessel_batch(main.load_model(name), *inputs)
+            for score, stats in zip(scores, main.vessel_mask_statistics(masks)):
+                score[name] = {'features': dict(zip(main.VESSEL_FEATURE_NAMES, map(float, stats)))}
+            if mask_dir:
+                for (row, eyes, _), mask in zip(loaded, masks):
+                    write_mask(mask_dir, row['id'], mask, eyes[0][1])
+        elif name == 'fusion':
+            models = [main.load_model(dependency) for dependency in main.MODEL_DEPENDENCIES[name]]
+            for score, result in zip(scores, main.predict_fusion_batch(*inputs, *models)):
+                score[name] = result
+    return scores
+
+
+def write_mask(mask_dir, row_id, prob_mask, original_size):
+    """Binary vessel mask at the original image size, as /predict returns it"""
+    mask = Image.fromarray((prob_mask > 0.5).astype(np.uint8) * 255, mode='L')
+    safe_id = "".join(c if c.isalnum() or c in '-_.' else '_' for c in row_id)
+    mask.resize(original_size, Image.NEAREST).save(os.path.join(mask_dir, f"{safe_id}.png"))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='CSV or Parquet file with id, left and right columns')
+    parser.add_argument('output', help='JSON-lines output file, appended to and used for resuming')
+    parser.add_argument('--models', nargs='+', choices=list(main.MODEL_PATHS), default=list(main.MODEL_PATHS))
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help='Decode worker processes')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Rows decoded ahead of the models (default: 2 batches)')
+    parser.add_argument('--image-root', help='Directory relative image paths are resolved against')
+    parser.add_argument('--id-column', default='id')
+    parser.add_argument('--left-column', default='left')
+    parser.add_argument('--right-column', default='right')
+    parser.add_argument('--vessel-masks', metavar='DIR', help='Also write vessel masks as PNGs to DIR')
+    args = parser.parse_args()
+
+    # Dependencies first (e.g. hypertension before fusion), each model once
+    model_names = [name for name in main.MODEL_PATHS if name in args.models]
+    sizes = tuple(
+        tuple(sorted({main.MODEL_INPUT_SIZES[name][eye] for name in model_names
+                      if len(main.MODEL_INPUT_SIZES[name]) > eye}))
+        for eye in range(2)
+    )
+
+    rows = read_manifest(args.manifest, args.id_column, args.left_column, args.right_column, args.image_root)
+    done = completed_ids(args.output)
+    todo = [row for row in rows if row['id'] not in done]
+    print(f"{len(rows)} rows in manifest, {len(rows) - len(todo)} already scored, {len(todo)} to go")
+    if not todo:
+        return
+    if args.vessel_masks:
+        os.makedirs(args.vessel_masks, exist_ok=True)
+
+    # Start the decode workers before torch spins up its thread pools
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=main._init_preprocess_process)
+    try:
+        executor.submit(int).result()
+        main.ensure_model_files(list(dict.fromkeys(
+            dependency for name in model_names for dependency in main.MODEL_DEPENDENCIES[name]
+        )))
+        for name in model_names:
+            for dependency in main.MODEL_DEPENDENCIES[name]:
+                main.load_model(dependency)
+
+        start = time.perf_counter()
+        scored = failed = 0
+        depth = args.prefetch or 2 * args.batch_size
+        with open(args.output, 'a') as out:
+            for batch in batches(prefetch(executor, todo, sizes, depth), args.batch_size):
+                loaded = [item for item in batch if item[2] is None]
+                scores = iter(score_batch(loaded, model_names, args.vessel_masks) if loaded else [])
+                for row, _, error in batch:
+                    record = {'id': row['id'], 'error': error} if error else {'id': row['id'], **next(scores)}
+                    out.write(json.dumps(record) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+
+                scored += len(loaded)
+                failed += len(batch) - len(loaded)
+                elapsed = time.perf_counter() - start
+                print(f"  {scored + failed}/{len(todo)} rows ({failed} failed), "
+                      f"{(scored + failed) / elapsed:.1f} rows/s", flush=True)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    if failed:
+        print(f"{failed} rows could not be scored; see their 'error' entries in {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,9 @@
+"""Run the tests on synthetic models: no checkpoint files or downloads needed"""
+import os
+import sys
+
+os.environ.setdefault('SYNTHETIC_MODELS', '1')
+os.environ.setdefault('WARMUP_MODELS', '0')
+os.environ.setdefault('RESULT_CACHE_MB', '16')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,106 @@
+"""Model downloads against a local HTTP server: resume, restart, 416 and checksum failures"""
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+import main
+
+DATA = os.urandom(256 * 1024)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Set by each test: 'truncate' (first response cut short), 'ignore_range' or '416'
+    mode = 'ok'
+    requests = []
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        Handler.requests.append(range_header)
+        offset = int(range_header[len('bytes='):].rstrip('-')) if range_header else 0
+        if range_header and self.mode == '416':
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(DATA)}')
+            self.end_headers()
+            return
+        if range_header and self.mode != 'ignore_range':
+            body = DATA[offset:]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{len(DATA) - 1}/{len(DATA)}')
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.mode == 'truncate' and len(Handler.requests) == 1:
+            # Drop the connection halfway through the first response
+            self.wfile.write(body[:len(body) // 2])
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    Handler.requests = []
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/vessel.pth"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def model_path(tmp_path, server, monkeypatch):
+    path = str(tmp_path / 'vessel.pth')
+    monkeypatch.setitem(main.MODEL_PATHS, 'vessel', path)
+    monkeypatch.setitem(main.MODEL_URLS, 'vessel', server)
+    monkeypatch.setattr(main, 'DOWNLOAD_CHUNK_SIZE', 16 * 1024)
+    monkeypatch.setattr(main.time, 'sleep', lambda seconds: None)
+    monkeypatch.setenv('VESSEL_MODEL_SHA256', hashlib.sha256(DATA).hexdigest())
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_truncated_download_resumes_with_range(model_path, monkeypatch):
+    monkeypatch.setattr(Handler, 'mode', 'truncate')
+    assert main.ensure_model_file('vessel') == model_path
+    assert read(model_path) == DATA
+    assert Handler.requests[0] is None
+    assert Handler.requests[1] == f'bytes={len(DATA) // 2}-'
+    assert not os.path.exists(model_path + '.part')
+
+
+def test_range_ignored_restarts_download(model_path, monkeypatch):
+    monkeypatch.setattr(Handler, 'mode', 'ignore_range')
+    with open(model_path + '.part', 'wb') as f:
+        f.write(b'stale partial download')
+    main.ensure_model_file('vessel')
+    assert Handler.requests == ['bytes=22-']
+    assert read(model_path) == DATA
+
+
+def test_416_keeps_complete_part_file(model_path, monkeypatch):
+    monkeypatch.setattr(Handler, 'mode', '416')
+    with open(model_path + '.part', 'wb') as f:
+        f.write(DATA)
+    main.ensure_model_file('vessel')
+    assert Handler.requests == [f'bytes={len(DATA)}-']
+    assert read(model_path) == DATA
+
+
+def test_checksum_mismatch_leaves_no_file(model_path, monkeypatch):
+    monkeypatch.setenv('VESSEL_MODEL_SHA256', '0' * 64)
+    with pytest.raises(RuntimeError, match='Checksum mismatch'):
+        main.ensure_model_file('vessel')
+    assert not os.path.exists(model_path)
+    assert not os.path.exists(model_path + '.part')
@@ -0,0 +1,21 @@
+"""TorchScript export: every model, traced with synthetic weights, saved and loaded back, matches eager"""
+import pytest
+import torch
+
+import export_models
+import main
+
+
+@pytest.mark.parametrize('model_name', list(main.MODEL_PATHS))
+def test_compiled_model_matches_eager(model_name, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'COMPILED_MODEL_DIR', str(tmp_path))
+    model = main.load_model_uncached(model_name, 'fp32', use_compiled=False)
+    adapter, compiled = export_models.compile_model(model_name, model)
+
+    path = main.compiled_artifact_path(model_name, 'fp32')
+    torch.jit.save(compiled, path)
+    reloaded = main.load_compiled_model(model_name, 'fp32', torch.device('cpu'), path=path)
+    assert isinstance(reloaded, main.CompiledModel)
+
+    worst, ok = export_models.check_parity(model_name, adapter, reloaded, 'fp32')
+    assert ok, f"max |compiled - eager| = {worst:.2e} exceeds {export_models.TOLERANCES['fp32']:.0e}"
@@ -0,0 +1,58 @@
+"""Model residency under MODEL_MEMORY_BUDGET_MB, on synthetic models (no checkpoint files)"""
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+
+MB = 2 ** 20
+
+
+def image_file(name):
+    buffer = io.BytesIO()
+    pixels = np.random.default_rng().integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(buffer, 'PNG')
+    return (name, buffer.getvalue(), 'image/png')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def with_budget(budget_mb):
+        monkeypatch.setattr(main, 'models', {})
+        monkeypatch.setattr(main, 'residency', main.ModelResidency(int(budget_mb * MB)))
+        return TestClient(main.app)
+    return with_budget
+
+
+def test_multi_with_budget(client):
+    http = client(1024)
+    response = http.post('/predict/multi', data={'models': 'cimt,vessel'},
+                         files={'left_image': image_file('l.png'), 'right_image': image_file('r.png')})
+    assert response.status_code == 200, response.text
+    assert set(response.json()['results']) == {'cimt', 'vessel'}
+    assert main.residency.stats()['models']['cimt']['pinned'] == 0
+
+
+def test_back_within_budget_after_request(client):
+    # cimt and vessel together (~110 MB) exceed the budget while the request pins them
+    http = client(50)
+    response = http.post('/predict/multi', data={'models': 'cimt,vessel'},
+                         files={'left_image': image_file('l.png'), 'right_image': image_file('r.png')})
+    assert response.status_code == 200, response.text
+    stats = main.residency.stats()
+    assert stats['resident_bytes'] <= stats['budget_bytes']
+    assert stats['evictions'] >= 1
+    assert 'cimt' not in main.models
+
+
+def test_cached_result_loads_no_model(client):
+    http = client(1024)
+    files = {'image': image_file('a.png')}
+    assert http.post('/predict', data={'model': 'vessel'}, files=files).status_code == 200
+    main.models.clear()
+    response = http.post('/predict', data={'model': 'vessel'}, files=files)
+    assert response.status_code == 200
+    assert 'vessel' not in main.models
@@ -1,5 +1,6 @@
 import sys
 import os
+import tempfile
 
 # Add paths for imports
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -19,6 +20,14 @@ if not os.path.exists(models_dir):
 os.makedirs(models_dir, exist_ok=True)
 os.environ['MODEL_DIR'] = models_dir
 
+# Memory-mapped checkpoint cache - /tmp is writable and survives warm invocations
+os.environ.setdefault('MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cvd-model-cache'))
+# On AWS Lambda (which sets AWS_LAMBDA_FUNCTION_MEMORY_SIZE) keep model weights within
+# half of the function's memory, leaving the rest to the torch runtime and activations.
+# Evicted models reload from the cache above. MODEL_MEMORY_BUDGET_MB overrides this.
+if os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE'):
+    os.environ.setdefault('MODEL_MEMORY_BUDGET_MB', str(int(os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']) // 2))
+
 # Set model URLs to download from Hugging Face Hub
 HF_REPO = os.environ.get('HF_MODEL_REPO', 'carlwakim/cvd-risk-models')
 os.environ['HYPERTENSION_MODEL_URL'] = os.environ.get('HYPERTENSION_MODEL_URL', f'https://huggingface.co/{HF_REPO}/resolve/main/hypertension.pt')
@@ -1,5 +1,6 @@
 import sys
 import os
+import tempfile
 
 # Add paths for imports
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -12,6 +13,9 @@ models_dir = os.path.join(current_dir, 'models')
 os.makedirs(models_dir, exist_ok=True)
 os.environ['MODEL_DIR'] = models_dir
 
+# Memory-mapped checkpoint cache - /tmp is writable and survives warm invocations
+os.environ.setdefault('MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cvd-model-cache'))
+
 # Set model URLs to download from Hugging Face Hub
 HF_REPO = os.environ.get('HF_MODEL_REPO', 'carlwakim/cvd-risk-models')
 os.environ['HYPERTENSION_MODEL_URL'] = os.environ.get('HYPERTENSION_MODEL_URL', f'https://huggingface.co/{HF_REPO}/resolve/main/hypertension.pt')